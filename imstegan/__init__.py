@@ -1 +1,17 @@
-from .algo import *
\ No newline at end of file
+from . import algo
+
+
+__all__ = list(algo.__all__)
+
+
+def __getattr__(name):
+    # Algorithms are loaded on first use, see `imstegan.algo`
+    if name in algo.__all__:
+        algorithm = algo.load(name)
+        globals()[name] = algorithm
+        return algorithm
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(algo.__all__))
\ No newline at end of file
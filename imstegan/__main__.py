@@ -1,8 +1,11 @@
 import argparse
-from PIL import Image
-import numpy as np
+import json
+import sys
+from contextlib import nullcontext
 import imstegan
-import cv2 
+from imstegan.io import PNG_STRATEGIES, decode, encode
+from imstegan.utils import profile
+from imstegan.batch import expand_inputs, process_files
 
 def parse_args():
     parser = argparse.ArgumentParser(description='LSB embedding and extraction')
@@ -14,16 +17,38 @@ def parse_args():
     parser.add_argument('--n_lsb', type=int, default=1, help='Number of least significant bits used for embedding if LSB is used')
     parser.add_argument('--output_path', type=str, default='output.png', help='Output path for saving image')
     parser.add_argument('--extract', action='store_true', help='Extract message from image')
+    parser.add_argument('--compress_level', type=int, default=6, choices=range(10), help='PNG compression level of output images, from 0 (fastest) to 9 (smallest)')
+    parser.add_argument('--png_strategy', type=str, default='default', choices=list(PNG_STRATEGIES), help='zlib strategy of output PNG images, huffman is much faster')
     parser.add_argument('--extract_to_file', type=str, default=None, help='Output path for saving extracted message')
+    parser.add_argument('--profile', type=str, nargs='?', const='-', default=None,
+                        help='Print a stage timing breakdown, or save it as JSON to the given path')
+    parser.add_argument('--inputs', type=str, nargs='+', default=None, help='Images, directories or glob patterns to be processed in batch')
+    parser.add_argument('--input_list', type=str, default=None, help='Text file listing one image path per line to be processed in batch')
+    parser.add_argument('--output_dir', type=str, default=None, help='Output directory for batch results')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes for batch mode, all CPUs by default')
+    parser.add_argument('--manifest', type=str, default='-', help='Output path for the JSONL batch manifest, stdout by default')
     return parser.parse_args()
 
+def run_batch(args, algorithm, message):
+    if not args.extract and not args.output_dir:
+        sys.exit('Batch embedding needs --output_dir')
+    inputs = expand_inputs(args.inputs or (), args.input_list)
+    manifest = sys.stdout if args.manifest == '-' else open(args.manifest, 'w')
+    failed = 0
+    try:
+        for record in process_files(algorithm, inputs, None if args.extract else message,
+                                    args.output_dir, args.workers, args.compress_level, args.png_strategy):
+            failed += record['status'] != 'ok'
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+    finally:
+        if manifest is not sys.stdout:
+            manifest.close()
+    if failed:
+        sys.exit(f'{failed} file(s) failed, see the manifest')
+
 def main():
     args = parse_args()
-    if args.algorithm_name=="LSBM":
-        image = cv2.imread(args.image_path,cv2.IMREAD_GRAYSCALE)        
-    else:
-        image = np.array(Image.open(args.image_path))
-
     message = args.message
     algorithm = getattr(imstegan, args.algorithm_name)
     kwargs = {
@@ -38,9 +63,29 @@ def main():
     else:
         message = args.message
 
+    if args.inputs or args.input_list:
+        # Process many images in one run
+        run_batch(args, algorithm(**kwargs), message)
+        return
+
+    # LSBM works on grayscale images
+    image = decode(args.image_path, 'gray' if args.algorithm_name=="LSBM" else None)
+
+    with profile(memory=True) if args.profile else nullcontext() as stages:
+        if args.extract:
+            # Extract message from image
+            message = algorithm(**kwargs).extract(image)
+        else:
+            # Otherwise embed message into image
+            image = algorithm(**kwargs).embed(image, message)
+
+    if args.profile == '-':
+        print(stages.report(), file=sys.stderr)
+    elif args.profile:
+        with open(args.profile, 'w') as f:
+            json.dump(stages.as_dict(), f, indent=2)
+
     if args.extract:    
-        # Extract message from image
-        message = algorithm(**kwargs).extract(image)
         if args.extract_to_file:    
             # Save extracted message to file
             with open(args.extract_to_file, 'w') as f:
@@ -49,12 +94,7 @@ def main():
             # Print extracted message to console
             print(message)
     else:
-        # Otherwise embed message into image
-        image = algorithm(**kwargs).embed(image, message)
-        if args.algorithm_name=="LSBM":
-            cv2.imwrite(args.output_path,image)
-        else:
-            Image.fromarray(image).save(args.output_path)
+        encode(image, args.output_path, compress_level=args.compress_level, strategy=args.png_strategy)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
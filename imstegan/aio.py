@@ -0,0 +1,140 @@
+"""asyncio counterparts of embed and extract.
+
+The blocking work (image decoding, the algorithm itself and PNG encoding)
+runs in an executor, a thread pool by default, so the event loop is never
+stalled. An `AsyncRunner` bounds the number of jobs handed to the executor
+at once; further requests wait for a free slot, which gives back-pressure
+when many requests are in flight.
+"""
+import asyncio
+import os
+import weakref
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Optional, Union
+
+import numpy as np
+
+from .io import decode, encode
+
+
+__all__ = ["AsyncRunner", "aembed", "aextract", "aembed_file", "aextract_file"]
+
+
+def _embed(algorithm, image, message, kwargs):
+    return algorithm.embed(image, message, **kwargs)
+
+
+def _extract(algorithm, image, kwargs):
+    return algorithm.extract(image, **kwargs)
+
+
+def _embed_file(algorithm, source, message, output):
+    return encode(algorithm.embed(decode(source), message), output)
+
+
+def _extract_file(algorithm, source, kwargs):
+    return algorithm.extract(decode(source), **kwargs)
+
+
+class AsyncRunner():
+    """Runs embed/extract jobs in an executor with bounded concurrency.
+
+    Cancelling a request drops its job if it has not started yet. A job that
+    is already running cannot be interrupted; its slot is only given back
+    once it ends, so the limit always holds.
+
+    Args:
+        executor (Executor): Where jobs run, a `ThreadPoolExecutor` with one
+            thread per CPU by default. With a `ProcessPoolExecutor`,
+            algorithms, images and messages are pickled.
+        max_concurrency (int): Number of jobs handed to the executor at
+            once, twice the number of CPUs by default.
+    """
+    def __init__(self, executor: Optional[Executor] = None, max_concurrency: Optional[int] = None) -> None:
+        self._owned = executor is None
+        self.executor = executor or ThreadPoolExecutor(os.cpu_count() or 1)
+        self.max_concurrency = max_concurrency or 2 * (os.cpu_count() or 1)
+        # asyncio primitives belong to one event loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def run(self, fn, *args):
+        """Runs `fn(*args)` in the executor once a slot is free."""
+        async with self._semaphore():
+            job = self.executor.submit(fn, *args)
+            try:
+                return await asyncio.shield(asyncio.wrap_future(job))
+            except asyncio.CancelledError:
+                if not job.cancel():
+                    # Already running, keep the slot until it is done
+                    await asyncio.wait([asyncio.wrap_future(job)])
+                raise
+
+    async def aembed(self, algorithm: Any, image: np.ndarray, message: Any, **kwargs: Any) -> np.ndarray:
+        """`algorithm.embed(image, message, **kwargs)` in the executor."""
+        return await self.run(_embed, algorithm, image, message, kwargs)
+
+    async def aextract(self, algorithm: Any, image: np.ndarray, **kwargs: Any) -> Union[str, bytes]:
+        """`algorithm.extract(image, **kwargs)` in the executor."""
+        return await self.run(_extract, algorithm, image, kwargs)
+
+    async def aembed_file(self, algorithm: Any, source: Union[str, bytes, memoryview], message: Any,
+                          output: Optional[str] = None) -> Union[str, bytes]:
+        """
+        Decodes an image file or its encoded bytes, embeds `message` and
+        encodes the result as PNG, all in one executor job (see
+        `imstegan.io`). Returns the PNG bytes, or `output` after saving it
+        there in the format of its extension.
+        """
+        return await self.run(_embed_file, algorithm, source, message, output)
+
+    async def aextract_file(self, algorithm: Any, source: Union[str, bytes, memoryview],
+                            **kwargs: Any) -> Union[str, bytes]:
+        """Decodes an image file or its encoded bytes and extracts its message in the executor."""
+        return await self.run(_extract_file, algorithm, source, kwargs)
+
+    def close(self) -> None:
+        """Shuts the executor down if the runner created it."""
+        if self._owned:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+_default_runner = None
+
+
+def _runner(runner):
+    global _default_runner
+    if runner is not None:
+        return runner
+    if _default_runner is None:
+        _default_runner = AsyncRunner()
+    return _default_runner
+
+
+async def aembed(algorithm: Any, image: np.ndarray, message: Any, runner: Optional[AsyncRunner] = None,
+                 **kwargs: Any) -> np.ndarray:
+    """Async `embed`, on `runner` or a default thread pool runner."""
+    return await _runner(runner).aembed(algorithm, image, message, **kwargs)
+
+
+async def aextract(algorithm: Any, image: np.ndarray, runner: Optional[AsyncRunner] = None,
+                   **kwargs: Any) -> Union[str, bytes]:
+    """Async `extract`, on `runner` or a default thread pool runner."""
+    return await _runner(runner).aextract(algorithm, image, **kwargs)
+
+
+async def aembed_file(algorithm: Any, source: Union[str, bytes, memoryview], message: Any,
+                      output: Optional[str] = None, runner: Optional[AsyncRunner] = None) -> Union[str, bytes]:
+    """Async decode, embed and PNG encode, see `AsyncRunner.aembed_file`."""
+    return await _runner(runner).aembed_file(algorithm, source, message, output)
+
+
+async def aextract_file(algorithm: Any, source: Union[str, bytes, memoryview], runner: Optional[AsyncRunner] = None,
+                        **kwargs: Any) -> Union[str, bytes]:
+    """Async decode and extract, see `AsyncRunner.aextract_file`."""
+    return await _runner(runner).aextract_file(algorithm, source, **kwargs)
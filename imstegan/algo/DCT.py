@@ -1,9 +1,12 @@
 import warnings
-from typing import Any
+from typing import Any, Dict, Optional, Tuple, Union
 import cv2
 import numpy as np
 
-from ..utils import message_to_binary, binary_to_message, rgb_to_gray, dct8x8, idct8x8
+from ..utils import (BitStream, payload_bits, bytes_to_message, rgb_to_gray, blockview, dct8x8_blocks,
+                     idct8x8_blocks, chunk_bounds, row_bands, check_capacity, payload_decoder, output_buffer,
+                     stage, is_multichannel, map_channels, embed_channels, extract_channels, channels_capacity)
+from ..metrics import compare
 
 
 __all__ = ["DCTScale"]
@@ -25,14 +28,95 @@ class DCTScale():
     """A naive steganographic method for images using Discrete Cosine Transform.
     This method embeds a message in an image by changing quantized DCT coefficients.
     This is currently broken if encounter near white or black pixels."""
-    def __init__(self, quantization_factor: int = 16, **kwargs: Any) -> None:
+    def __init__(self, quantization_factor: int = 16, framed: bool = False, multichannel: bool = False,
+                 **kwargs: Any) -> None:
         self._factor = quantization_factor
+        self._framed = framed
+        self._multichannel = multichannel
         pass
     
-    def embed(self, image: np.ndarray, message: str) -> np.ndarray:
+    def _quantized_dct(self, img):
+        """Quantized DCT coefficient plane of a uint8 image made of whole 8x8 blocks."""
+        dct_coef = np.empty(img.shape)
+        dct8x8_blocks(blockview(img.astype(np.short) - 128), out=blockview(dct_coef))
+        return (dct_coef/self._factor).round().astype(np.short)
+
+    def _embed_coefficients(self, coef, binary_msg):
+        """Embeds into a raster-ordered coefficient array in place, returns the number of bits used."""
+        if not len(binary_msg):
+            return 0
+        # Coefficients are visited in raster order up to the one carrying the
+        # last bit. Those with |q| > 2 carry one bit each in their parity and
+        # are moved towards zero when it is wrong, those with |q| == 2 are
+        # shrunk to +/-1 so that they are not mistaken for carriers.
+        carriers = np.abs(coef) > 2
+        count = np.cumsum(carriers)
+        stop = np.searchsorted(count, len(binary_msg)) + 1
+        visited = coef[:stop]
+        twos = np.abs(visited) == 2
+        pos = np.flatnonzero(carriers[:stop])
+        wrong = pos[visited[pos] % 2 != binary_msg[:len(pos)]]
+        visited[wrong] -= np.sign(visited[wrong])
+        visited[twos] = np.sign(visited[twos])
+        return len(pos)
+
+    def _band_capacity(self, img, start, stop):
+        """Number of bits the block rows `[start, stop)` hold."""
+        return int(np.count_nonzero(np.abs(self._quantized_dct(img[8 * start:8 * stop])) > 2))
+
+    def _embed_rows(self, img, binary_msg, bands, check=True):
+        """
+        Embeds into the uint8 image `img`, whose sides are multiples of 8, in
+        place, a band of block rows of the list `bands` at a time. With
+        `check`, raises `ValueError` before writing anything if the message
+        does not fit.
+        """
+        if check:
+            with stage('DCTScale.dct'):
+                check_capacity(lambda start, stop: self._band_capacity(img, start, stop), bands, len(binary_msg))
+        offset = 0
+        for start, stop in bands:
+            band = img[8 * start:8 * stop]
+            with stage('DCTScale.dct', band.size):
+                dct_coef = self._quantized_dct(band)
+            with stage('DCTScale.write'):
+                offset += self._embed_coefficients(dct_coef.ravel(), binary_msg[offset:])
+
+            # Every block is requantized, so bands past the message are
+            # transformed too to give the same result as a single pass
+            with stage('DCTScale.idct', band.size):
+                dct_coef *= self._factor
+                img2 = np.empty(band.shape)
+                idct8x8_blocks(blockview(dct_coef), out=blockview(img2))
+                img2 += 128
+                band[...] = img2.clip(0, 255).astype(np.uint8)
+
+        if offset < len(binary_msg):
+            raise ValueError(f"Message is too large for the image: needs {len(binary_msg)} bits, "
+                             f"capacity is {offset}")
+
+    def _extract_rows(self, image, first, largest):
+        """
+        Decodes `image` a band of block-rows at a time, `first` growing to
+        `largest`, and stops transforming at the end of the message.
+        """
+        # Only complete 8x8 blocks carry data, at most one bit per coefficient
+        w = image.shape[1] // 8 * 8
+        decoder = payload_decoder(framed=self._framed, capacity=image.shape[0] // 8 * 8 * w)
+        for start, stop in chunk_bounds(image.shape[0] // 8, first=first, largest=largest):
+            with stage('DCTScale.dct', 8 * (stop - start) * w):
+                coef = self._quantized_dct(image[8 * start:8 * stop, :w]).ravel()
+            # Parity of every coefficient with |q| > 1, in raster order
+            with stage('DCTScale.decode'):
+                if decoder.feed((coef[np.abs(coef) > 1] % 2).astype(np.uint8)):
+                    break
+
+        return decoder.message()
+
+    def _prepare(self, image):
+        """Grayscale uint8 version of `image` resized to multiples of 8."""
         img = _to_grayscale(image).astype(np.short)
         h, w = img.shape[:2]
-        binary_msg = message_to_binary(message + '\0')
 
         # Pad/resize to multiple of 8
         pad_h = 8 - h % 8 if h % 8 != 0 else 0
@@ -42,66 +126,89 @@ class DCTScale():
         #     ((floor(pad_h/2), ceil(pad_h/2)), (floor(pad_w/2), ceil(pad_w/2))), 
         #     'constant', constant_values=0
         # )
-        img = cv2.resize(img, (w + pad_w, h + pad_h))
-        h, w = img.shape[:2]
-        dct_coef = np.zeros((h, w))
-
-        for i in range(0, h, 8):
-            for j in range(0, w, 8):
-                dct_coef[i:i+8, j:j+8] = dct8x8(img[i:i+8, j:j+8] - 128)
-
-        dct_coef = (dct_coef/self._factor).round().astype(np.short)
-
-        img2 = np.zeros((h, w))
-
-        for i in range(h):
-            for j in range(w):
-                if not binary_msg: break
-                if abs(dct_coef[i, j]) > 2:
-                    if dct_coef[i, j] % 2 != int(binary_msg[0]):
-                        if dct_coef[i, j] > 0:
-                            dct_coef[i, j] -= 1
-                        else:
-                            dct_coef[i, j] += 1
-                    binary_msg = binary_msg[1:]
-                elif abs(dct_coef[i, j]) == 2:
-                        if dct_coef[i, j] > 0:
-                            dct_coef[i, j] = 1
-                        else:
-                            dct_coef[i, j] = -1
-        dct_coef *= self._factor
-        for i in range(0, h, 8):
-            for j in range(0, w, 8):
-                img2[i:i+8, j:j+8] = idct8x8(dct_coef[i:i+8, j:j+8]) + 128
-        return img2.clip(0, 255).astype(np.uint8)
+        return cv2.resize(img, (w + pad_w, h + pad_h)).astype(np.uint8)
+
+    def capacity(self, image: np.ndarray) -> int:
+        """Number of bits `embed` can hide in `image`, delimiter or header included."""
+        if self._multichannel and is_multichannel(image):
+            # One plane at a time, the DCT kernel already uses every core
+            return channels_capacity(map_channels(lambda k: self.capacity(image[..., k]), image.shape[2], workers=1),
+                                     self._framed)
+        img = self._prepare(image)
+        bands = row_bands(img.shape[0] // 8, 8 * img.shape[1])
+        return sum(self._band_capacity(img, start, stop) for start, stop in bands)
+
+    def embed(self, image: np.ndarray, message: Union[str, bytes, BitStream],
+              out: Optional[np.ndarray] = None, inplace: bool = False,
+              metrics: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, Dict[str, float]]]:
+        """
+        Returns the stego image, written into a new array, into `out` (a 2-D
+        uint8 array of the resized shape) when given, or into `image` itself
+        with `inplace=True`, which needs sides that are multiples of 8.
+        With `metrics=True`, returns `(stego, metrics)` instead, see
+        `imstegan.metrics.compare`; the cover is the carrier as embedded
+        into, e.g. after grayscale conversion and
+        resizing.
+        """
+        if self._multichannel and is_multichannel(image):
+            if image.shape[0] % 8 == 0 and image.shape[1] % 8 == 0:
+                return embed_channels(self, image, message, out, inplace, workers=1, metrics=metrics)
+            if inplace:
+                raise ValueError("In-place DCTScale embedding needs sides that are multiples of 8")
+            # Every plane is resized on its own. Not embedding in place into
+            # them spares the capacity check of every plane, at the cost of a copy
+            planes = np.stack([self._prepare(image[..., k]) for k in range(image.shape[2])], axis=-1)
+            return embed_channels(self, planes, message, out, workers=1, metrics=metrics)
+        with stage('DCTScale.grayscale', image.shape[0] * image.shape[1]):
+            if image.shape[0] % 8 == 0 and image.shape[1] % 8 == 0:
+                # No resizing needed
+                img = output_buffer(image, out, inplace, grayscale=True)
+            elif inplace:
+                raise ValueError("In-place DCTScale embedding needs sides that are multiples of 8")
+            else:
+                img = self._prepare(image)
+                if out is not None:
+                    img = output_buffer(img, out)
+        cover = img.copy() if metrics else None
+        with stage('DCTScale.bits'):
+            binary_msg = payload_bits(message, framed=self._framed)
+        # Every block is requantized, so all bands are gone through. Capacity
+        # is only checked beforehand for the caller's arrays, a new one left
+        # half written is dropped along with the error
+        self._embed_rows(img, binary_msg, list(row_bands(img.shape[0] // 8, 8 * img.shape[1])),
+                         check=inplace or out is not None)
+        if cover is None:
+            return img
+        with stage('DCTScale.metrics', img.size):
+            return img, compare(cover, img)
     
-    def extract(self, image: np.ndarray) -> str:
-        img = image.astype(np.short)
-        h, w = img.shape[:2]
-        binary_msg = ''
-        completed = False
-        dct_coef = np.zeros((h, w))
-
-        for i in range(0, h, 8):
-            for j in range(0, w, 8):
-                dct_coef[i:i+8, j:j+8] = dct8x8(img[i:i+8, j:j+8] - 128)
-
-        dct_coef = (dct_coef/self._factor).round().astype(np.short)
-        
-        for i in range(h):
-            if completed: break
-            for j in range(w):
-                if completed: break
-                if abs(dct_coef[i, j]) > 1:
-                    if dct_coef[i, j] % 2 == 1:
-                        binary_msg += '1'
-                    else:
-                        binary_msg += '0'
-                    # End of message check
-                    rem = len(binary_msg) % 8
-                    if binary_msg[-rem-8:-rem] == "00000000":
-                        completed = True
-                        binary_msg = binary_msg[:-rem-8]
-                        break
-                
-        return binary_to_message(binary_msg)
+    def extract(self, image: np.ndarray, as_bytes: bool = False) -> Union[str, bytes]:
+        if self._multichannel and is_multichannel(image):
+            data = extract_channels(self, image, workers=1)
+            return data if as_bytes else bytes_to_message(data)
+        # Short messages only pay for the first blocks
+        data = self._extract_rows(image, first=2, largest=128)
+        return data if as_bytes else bytes_to_message(data)
+
+    def embed_tiled(self, carrier: np.ndarray, message: Union[str, bytes, BitStream],
+                    tile_rows: int = 1024) -> np.ndarray:
+        """
+        Embeds in place into a 2-D uint8 carrier, e.g. an `np.memmap`, processing
+        `tile_rows` rows at a time. Both sides of the carrier must be multiples
+        of 8, as it cannot be resized; the result is then the same as `embed`.
+        """
+        if carrier.shape[0] % 8 or carrier.shape[1] % 8:
+            raise ValueError("Tiled DCTScale needs a carrier whose sides are multiples of 8")
+        block_rows = max(tile_rows // 8, 1)
+        bands = list(chunk_bounds(carrier.shape[0] // 8, first=block_rows, largest=block_rows))
+        self._embed_rows(carrier, payload_bits(message, framed=self._framed), bands)
+        if isinstance(carrier, np.memmap):
+            carrier.flush()
+        return carrier
+
+    def extract_tiled(self, carrier: np.ndarray, tile_rows: int = 1024,
+                      as_bytes: bool = False) -> Union[str, bytes]:
+        """Extracts from a 2-D carrier, transforming `tile_rows` rows at a time."""
+        block_rows = max(tile_rows // 8, 1)
+        data = self._extract_rows(carrier, first=block_rows, largest=block_rows)
+        return data if as_bytes else bytes_to_message(data)
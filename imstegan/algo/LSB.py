@@ -1,62 +1,139 @@
 import numpy as np
 
-from ..utils import message_to_binary, integer_to_binary, binary_to_message
+from ..utils import (payload_bits, bytes_to_message, values_to_bits, bits_to_values, chunk_bounds,
+                     payload_decoder, KeyedPermutation, output_buffer, stage)
+from ..metrics import compare
 
 
 class LSB():
-    def __init__(self, n_lsb=1, key=2022, delimeter='\0', **kwargs):
+    def __init__(self, n_lsb=1, key=2022, delimeter='\0', path='legacy', framed=False, **kwargs):
+        if path not in ('legacy', 'keyed'):
+            raise ValueError(f"Unknown path mode: {path}")
         self.n_lsb = n_lsb
         self.key = key
         self.delim = delimeter
+        self.path = path
+        self.framed = framed
 
-    def embed(self, image, message):
+    def _path(self, max_pos):
         """
-        Embeds a message into an image.
+        Returns a function mapping a range `[start, stop)` of the embedding
+        path to subpixel indices.
         """
-        message += self.delim
-        binary_message = message_to_binary(message)
-        int_message = [int(binary_message[i:i+self.n_lsb], 2) for i in range(0, len(binary_message), self.n_lsb)]
-        h, w, c = image.shape
-        max_pos = h * w * c
-        # Check if message length exceeds maximum bits for encoding
-        if len(int_message) > max_pos:
-            raise ValueError("Insufficient places to store data, need bigger image or less data !!")
-
-        # Create path for embedding data using key value
+        if self.path == 'keyed':
+            return KeyedPermutation(self.key, max_pos).take
         indices = np.arange(max_pos)
         np.random.seed(self.key)
         np.random.shuffle(indices)
-        indices = indices[:len(int_message)]
+        return lambda start, stop: indices[start:stop]
 
-        # Embed all data from message within the image
-        new_image = np.ravel(image.copy())
-        new_image[indices] = new_image[indices] & ~(2**self.n_lsb-1) | int_message
-        new_image = new_image.reshape(h, w, c)
-        return new_image
+    def _embed_path(self, flat, int_message, chunk):
+        """
+        Writes `int_message` into the flat image along the path in place,
+        `chunk` positions at a time.
+        """
+        with stage('LSB.path'):
+            path = self._path(flat.size)
+        mask = np.uint8(2**self.n_lsb - 1)
+        for start, stop in chunk_bounds(len(int_message), first=chunk, largest=chunk):
+            with stage('LSB.path'):
+                indices = path(start, stop)
+            with stage('LSB.write', stop - start):
+                values = int_message[start:stop].astype(np.uint8)
+                if stop - start < len(int_message):
+                    # Write in address order so tiles of a memory map are visited once
+                    order = np.argsort(indices)
+                    indices, values = indices[order], values[order]
+                flat[indices] = flat[indices] & ~mask | values
+
+    def _extract_path(self, flat, chunk):
+        # Extract data chunk by chunk until the end of the message
+        with stage('LSB.path'):
+            path = self._path(flat.size)
+        decoder = payload_decoder(self.delim.encode('latin-1'), self.framed, flat.size * self.n_lsb)
+        mask = 2**self.n_lsb - 1
+        for start, stop in chunk_bounds(flat.size, largest=chunk, limit=lambda: decoder.needed(self.n_lsb)):
+            with stage('LSB.path'):
+                indices = path(start, stop)
+            with stage('LSB.read', stop - start):
+                values = flat[indices] & mask
+            with stage('LSB.decode'):
+                if decoder.feed(values_to_bits(values, self.n_lsb)):
+                    break
+        return decoder.message()
+
+    def capacity(self, image):
+        """
+        Number of bits that can be embedded into an image, delimiter or header
+        included.
+        """
+        return image.size * self.n_lsb
 
-    def extract(self, image):
+    def embed(self, image, message, out=None, inplace=False, metrics=False):
         """
-        Extracts a message from an image.
+        Embeds a message into an image. The result is written into a new
+        array, into `out` (a uint8 array shaped like `image`) when given, or
+        into `image` itself with `inplace=True`, and returned. With
+        `metrics=True`, returns `(stego, metrics)` instead, see
+        `imstegan.metrics.compare`.
         """
+        with stage('LSB.bits'):
+            binary_message = payload_bits(message, self.delim.encode('latin-1'), self.framed)
+            int_message = bits_to_values(binary_message, self.n_lsb)
         h, w, c = image.shape
         max_pos = h * w * c
-        # Create path for extracting data using key value
-        indices = np.arange(max_pos)
-        np.random.seed(self.key)
-        np.random.shuffle(indices)
+        # Check if message length exceeds maximum bits for encoding
+        if len(int_message) > max_pos:
+            raise ValueError("Insufficient places to store data, need bigger image or less data !!")
 
-        # Extract all data from image
-        binary_delim = message_to_binary(self.delim)
-        binary_message = ''
-        image = np.ravel(image)
-        for i in indices:
-            binary_message += integer_to_binary(image[i] & (2**self.n_lsb-1))[-self.n_lsb:]
-            rem = len(binary_message) % 8
-            if binary_message[-rem-len(binary_delim):len(binary_message)-rem] == binary_delim:
-                binary_message = binary_message[:-rem-len(binary_delim)]
-                break
-        return binary_to_message(binary_message)
+        # Embed all data from message within the image
+        with stage('LSB.copy', max_pos):
+            new_image = output_buffer(image, out, inplace)
+        cover = new_image.copy() if metrics else None
+        flat = new_image.reshape(-1)
+        self._embed_path(flat, int_message, max(len(int_message), 1))
+        # Non-contiguous buffers were flattened into a copy
+        if not np.shares_memory(flat, new_image):
+            new_image[...] = flat.reshape(new_image.shape)
+        if cover is None:
+            return new_image
+        with stage('LSB.metrics', new_image.size):
+            return new_image, compare(cover, new_image)
+
+    def extract(self, image, as_bytes=False):
+        """
+        Extracts a message from an image.
+        """
+        data = self._extract_path(np.ravel(image), 1 << 20)
+        return data if as_bytes else bytes_to_message(data)
 
+    def embed_tiled(self, carrier, message, tile_rows=1024):
+        """
+        Embeds a message in place into a carrier, e.g. an `np.memmap`, handling
+        the positions of `tile_rows` rows worth of subpixels at a time. Memory
+        use only depends on the tile size with the keyed path. The result is
+        the same as `embed`.
+        """
+        binary_message = payload_bits(message, self.delim.encode('latin-1'), self.framed)
+        int_message = bits_to_values(binary_message, self.n_lsb)
+        if len(int_message) > carrier.size:
+            raise ValueError("Insufficient places to store data, need bigger image or less data !!")
+        if not carrier.flags.c_contiguous:
+            raise ValueError("Tiled LSB needs a C-contiguous carrier")
+        tile = tile_rows * (carrier.size // max(carrier.shape[0], 1))
+        self._embed_path(carrier.reshape(-1), int_message, max(tile, 1))
+        if isinstance(carrier, np.memmap):
+            carrier.flush()
+        return carrier
+
+    def extract_tiled(self, carrier, tile_rows=1024, as_bytes=False):
+        """
+        Extracts a message from a carrier, e.g. an `np.memmap`, reading at most
+        `tile_rows` rows worth of subpixels at a time.
+        """
+        tile = tile_rows * (carrier.size // max(carrier.shape[0], 1))
+        data = self._extract_path(carrier.reshape(-1), max(tile, 1))
+        return data if as_bytes else bytes_to_message(data)
 
 # class LSB():
 #     def __init__(self, n_lsb=1, key=2022, delimeter='\0', **kwargs):
@@ -1,101 +1,112 @@
-import numpy as np 
 import random
 
-from ..utils import message_to_binary, integer_to_binary
+import numpy as np
+
+from ..utils import (payload_bits, bytes_to_message, values_to_bits, chunk_bounds, payload_decoder,
+                     KeyedPermutation, output_buffer, stage)
+from ..metrics import compare
 
 class LSBM:
     """
     Image steganography using LSB Matching algorithm.
-    
+
     Args:
-        key (int): Random seed for pixel traversal order
+        key (int): Random seed for pixel traversal order and +/- 1 choices.
+            A fresh generator is derived from it on every call, so an
+            instance can be shared between threads and reused.
+        framed (bool): Prefix the message with a length header instead of
+            terminating it with a NUL byte
+        path (str): 'keyed' for a keyed permutation that only computes the
+            visited pixels, 'legacy' for the order of earlier versions, which
+            shuffles every pixel with `random.seed(key)`
     """
-    def __init__(self, key=2022):
+    def __init__(self, key=2022, framed=False, path='keyed', **kwargs):
+        if path not in ('legacy', 'keyed'):
+            raise ValueError(f"Unknown path mode: {path}")
         self._key = key
-        random.seed(key)
-    
-    def _embed_pixel(self, message, binary_pixel, message_index):
-        bit = message[message_index]
-        pixel = int(binary_pixel, 2)
-        if binary_pixel[-1] != bit:
-            pixel = self._random_increment_or_decrement(pixel)
-        return pixel
-    
-    def _random_increment_or_decrement(self, pixel):
-        random_number = random.random()
-        if pixel == 255:
-            return 254
-        if pixel == 0:
-            return 1
-        if random_number < 0.5:    
-            pixel += 1
-        else:
-            pixel -= 1     
-        return pixel
-    
-    def _binary_to_string(self, binary_message, delimiter):
-        delimiter_length = len(delimiter) * -1
-        delimiter_present = False
-        message_bytes = [binary_message[i : i + 8] for i in range(0, len(binary_message), 8)]
-        message = ""
-        for byte in message_bytes:
-            char = chr(int(byte, 2))
-            message += char
-            if message[delimiter_length:] == delimiter:   
-                message = message[:delimiter_length]
-                delimiter_present = True
-                break
-        return message, delimiter_present
+        self._framed = framed
+        self._path = path
+
+    def _generators(self, size):
+        """
+        Returns a function mapping a range `[start, stop)` of the traversal
+        order to pixel indices, and one returning a uniform draw for every
+        pixel of a boolean mask that has to change.
+        """
+        if self._path == 'legacy':
+            # One stream for both, drawn from like earlier versions did with
+            # the global `random` module right after seeding it
+            rng = random.Random(self._key)
+            indices = np.array(rng.sample(range(size), size))
+            return (lambda start, stop: indices[start:stop],
+                    lambda change: np.array([rng.random() for _ in range(np.count_nonzero(change))]))
+        # Traversal order and +/- 1 choices come from independent streams, so
+        # neither depends on the message length. The order is a keyed
+        # permutation, which only computes the positions that are visited.
+        path_seed, sign_seed = np.random.SeedSequence(self._key).spawn(2)
+        path_key = int(np.random.default_rng(path_seed).integers(2**63))
+        sign_rng = np.random.default_rng(sign_seed)
+        return KeyedPermutation(path_key, size).take, lambda change: sign_rng.random(len(change))[change]
 
-    def embed(self, image, message):
-        message = message + '\0'
-        binary_message = message_to_binary(message)
-        width = np.size(image, 1)
-        height = np.size(image, 0)
-        num_bytes = width * height
-        message_index = 0
+    def capacity(self, image):
+        # One bit per pixel, delimiter or header included
+        return image.size
+
+    def embed(self, image, message, out=None, inplace=False, metrics=False):
+        # The result goes to a new array, to `out`, or to `image` itself with `inplace`,
+        # along with the metrics of `imstegan.metrics.compare` with `metrics`
+        with stage('LSBM.bits'):
+            binary_message = payload_bits(message, framed=self._framed)
+        num_bytes = image.size
         message_length = len(binary_message)
         if message_length > num_bytes:
             raise ValueError("The message is too large for the image.")
+        image = output_buffer(image, out, inplace)
+        cover = image.copy() if metrics else None
+        cover_image = np.ravel(image)
+
+        with stage('LSBM.path'):
+            path, draw = self._generators(num_bytes)
+            path = path(0, message_length)
+
+        with stage('LSBM.write', message_length):
+            pixels = cover_image[path]
 
-        pixels = range(num_bytes)
-        path = random.sample(pixels, num_bytes)
-        cover_image = image 
-        for i in range(len(path)):
-            index = path[i]
-            x = index % width
-            y = index // width
-            pixel = cover_image[y][x]
-            embedded_pixel = pixel
-            binary_pixel = integer_to_binary(pixel)
-            embedded_pixel = self._embed_pixel(binary_message, binary_pixel, message_index)
+            # Pixels whose LSB differs from the bit are moved by +/- 1 at random,
+            # saturated values can only go one way
+            change = (pixels & 1) != binary_message
+            moved = pixels[change]
+            step = np.where(draw(change) < 0.5, 1, -1)
+            step[moved == 255] = -1
+            step[moved == 0] = 1
+            cover_image[path[change]] = moved + step
 
-            cover_image[y][x] = embedded_pixel
-            message_index += 1
+        # Non-contiguous buffers were flattened into a copy
+        if not np.shares_memory(cover_image, image):
+            image[...] = cover_image.reshape(image.shape)
+        if cover is None:
+            return image
+        with stage('LSBM.metrics', image.size):
+            return image, compare(cover, image)
 
-            if message_index == message_length:
-                break
-        stego_image = cover_image
-        return stego_image
-    
-    def extract(self, image):
-        binary_message = ""
-        width = np.size(image, 1)
-        height = np.size(image, 0)
-        num_bytes = width * height
-        pixels = range(num_bytes) 
-        path = random.sample(pixels,num_bytes)
-        for i in range(0, len(path)):
-            index = path[i]
-            x = index % width
-            y = index // width
-            stego_pixel = image[y][x]
-            binary_pixel = integer_to_binary(stego_pixel)
-            binary_message += binary_pixel[-1]
+    def extract(self, image, as_bytes=False):
+        image = np.ravel(image)
+        num_bytes = image.size
+        with stage('LSBM.path'):
+            path, _ = self._generators(num_bytes)
 
-        extracted_message, _ = self._binary_to_string(binary_message, '\0')
-        return extracted_message
+        decoder = payload_decoder(framed=self._framed, capacity=num_bytes)
+        for start, stop in chunk_bounds(num_bytes, limit=decoder.needed):
+            with stage('LSBM.path'):
+                indices = path(start, stop)
+            with stage('LSBM.read', stop - start):
+                values = image[indices]
+            with stage('LSBM.decode'):
+                if decoder.feed(values_to_bits(values, 1)):
+                    break
+        data = decoder.message()
+        return data if as_bytes else bytes_to_message(data)
 
     @property
     def key(self):
-        return self._key
\ No newline at end of file
+        return self._key
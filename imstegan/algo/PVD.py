@@ -1,10 +1,12 @@
-import math
 import warnings
-from typing import Any
+from typing import Any, Dict, Optional, Tuple, Union
 
 import numpy as np
 
-from ..utils import message_to_binary, binary_to_message, rgb_to_gray
+from ..utils import (rgb_to_gray, BitStream, payload_bits, bytes_to_message, values_to_bits,
+                     bits_to_values, chunk_bounds, row_bands, check_capacity, payload_decoder, output_buffer, stage,
+                     is_multichannel, map_channels, embed_channels, extract_channels, channels_capacity)
+from ..metrics import compare
 
 
 __all__ = ["PVD", "AdaptivePVD"]
@@ -27,83 +29,165 @@ class PVD():
     """Pixel-value differencing algorithm described in 
     `"A steganographic method for images by pixel-value differencing", Da-Chun Wu, Wen-Hsiang Tsai`
     """
-    def __init__(self, high_capacity: bool = False, **kwargs: Any) -> None:
+    def __init__(self, high_capacity: bool = False, framed: bool = False, multichannel: bool = False,
+                 **kwargs: Any) -> None:
+        self._framed = framed
+        self._multichannel = multichannel
         if high_capacity:
             self._range = (2, 2, 4, 4, 4, 8, 8, 16, 16, 32, 32, 64, 64)
         else:
             self._range = (8, 8, 16, 32, 64, 128)
+        # Range table: exclusive upper bound, lower bound and capacity in bits
+        self._upper = np.cumsum(self._range)
+        self._lower = self._upper - np.array(self._range)
+        self._bits = np.log2(self._range).astype(np.int64)
     
     def _f(self, l, r, d, dp):
         m = dp - d
-        return (l - math.ceil(m/2), r + math.floor(m/2)) if d % 2 != 0 \
-            else (l - math.floor(m/2), r + math.ceil(m/2))
+        floor, ceil = m // 2, -(-m // 2)
+        odd = d % 2 != 0
+        return np.where(odd, l - ceil, l - floor), np.where(odd, r + floor, r + ceil)
     
-    def _analyze_pair(self, a, b):
+    def _analyze_pairs(self, a, b):
+        """Classifies every pair `(a[i], b[i])` at once."""
         d = b - a
-        acc = 0
-        for k in range(len(self._range)):
-            if acc + self._range[k] - 1 < abs(d):
-                acc += self._range[k]
-            else:
-                l = acc
-                u = acc + self._range[k] - 1
-                break
-        n = int(math.log2(u - l + 1))
+        k = np.searchsorted(self._upper, np.abs(d), side='right')
+        l = self._lower[k]
+        u = self._upper[k] - 1
+        n = self._bits[k]
         # Range check
-        lu, ru = self._f(a, b, d, u if d >= 0 else -u)
-        overflow = (lu < 0 or lu > 255 or ru < 0 or ru > 255)
+        lu, ru = self._f(a, b, d, np.where(d >= 0, u, -u))
+        overflow = (lu < 0) | (lu > 255) | (ru < 0) | (ru > 255)
 
         return overflow, l, d, n
 
-    def embed(self, image: np.ndarray, message: str) -> np.ndarray:
-        img = _to_grayscale(image).astype(np.short)
-        h, w = img.shape[:2]
-        binary_msg = message_to_binary(message + '\0')
-
-        for i in range(h - 1):
-            if not binary_msg: break
-            for j in range(0, w - 2, 2):
-                if not binary_msg: break
-                overflow, l, d, n = self._analyze_pair(img[i, j], img[i, j + 1])
-                if overflow:
-                    continue
+    def _pairs(self, rows):
+        """Left and right pixels of the horizontal pairs of `rows`, in embedding order."""
+        w = rows.shape[1]
+        return rows[:, 0:w - 2:2], rows[:, 1:w - 1:2]
+
+    def _band_capacity(self, img, start, stop):
+        """Number of bits the pairs of rows `[start, stop)` hold."""
+        a, b = self._pairs(img[start:stop].astype(np.short))
+        overflow, _, _, n = self._analyze_pairs(a.ravel(), b.ravel())
+        return int(n[~overflow].sum())
+
+    def _embed_rows(self, img, binary_msg, bands, check=True):
+        """
+        Embeds into the uint8 image `img` in place, a band of rows of the list
+        `bands` at a time, up to the end of the message. With `check`, raises
+        `ValueError` before writing anything if the message does not fit.
+        """
+        if check:
+            with stage('PVD.analyze'):
+                check_capacity(lambda start, stop: self._band_capacity(img, start, stop), bands, len(binary_msg))
+        offset = 0
+        for start, stop in bands:
+            if offset >= len(binary_msg):
+                break
+            with stage('PVD.analyze') as s:
+                left, right = self._pairs(img[start:stop].astype(np.short))
+                per_row = max(left.shape[1], 1)
+                a, b = left.ravel(), right.ravel()
+                overflow, l, d, n = self._analyze_pairs(a, b)
+                s.touch(2 * len(a))
+
+            with stage('PVD.write') as s:
+                # Bit offset of every pair, pairs past the end of the message are unused
+                capacity = np.where(overflow, 0, n)
+                offsets = offset + np.cumsum(capacity) - capacity
+                used = np.flatnonzero((capacity > 0) & (offsets < len(binary_msg)))
+                info = bits_to_values(binary_msg[offset:], capacity[used])
+                offset += capacity[used].sum()
+
                 # Embed
-                b = int(binary_msg[:n], 2)
-                binary_msg = binary_msg[n:]
-                dp = l + b if d >= 0 else -(l + b)
-                nl, nr = self._f(img[i, j], img[i, j + 1], d, dp)
-                img[i, j] = nl
-                img[i, j + 1] = nr
-    
-        return img.astype(np.uint8)
-    
-    def extract(self, image: np.ndarray) -> str:
-        img = image.astype(np.short)
-        h, w = img.shape[:2]
-        binary_msg = ''
-        completed = False
-
-        for i in range(h - 1):
-            if completed: break
-            for j in range(0, w - 2, 2):
-                if completed: break
-                overflow, l, d, n = self._analyze_pair(img[i, j], img[i, j + 1])
-                if overflow:
-                    continue
-                # Extract
-                b = d - l if d >= 0 else -d - l
-                info = f"{b:b}"
-                if len(info) < n:
-                    info = "0" * (n - len(info)) + info
-                binary_msg += info
-                # End of message check
-                rem = len(binary_msg) % 8
-                if binary_msg[-rem-8:-rem] == "00000000":
-                    completed = True
-                    binary_msg = binary_msg[:-rem-8]
+                dp = np.where(d[used] >= 0, l[used] + info, -(l[used] + info))
+                nl, nr = self._f(a[used], b[used], d[used], dp)
+                rows, cols = np.divmod(used, per_row)
+                img[start + rows, 2 * cols] = nl
+                img[start + rows, 2 * cols + 1] = nr
+                s.touch(2 * len(used))
+
+        if offset < len(binary_msg):
+            raise ValueError(f"Message is too large for the image: needs {len(binary_msg)} bits, "
+                             f"capacity is {offset}")
+
+    def _extract_rows(self, image, first, largest):
+        # Every pair holds at most as many bits as the widest range
+        decoder = payload_decoder(framed=self._framed, capacity=image.size // 2 * int(self._bits.max()))
+
+        # Extract a band of rows at a time until the end of message
+        for start, stop in chunk_bounds(image.shape[0] - 1, first=first, largest=largest):
+            with stage('PVD.analyze') as s:
+                a, b = self._pairs(image[start:stop].astype(np.short))
+                overflow, l, d, n = self._analyze_pairs(a.ravel(), b.ravel())
+                s.touch(2 * a.size)
+            with stage('PVD.decode'):
+                keep = ~overflow
+                info = np.abs(d[keep]) - l[keep]
+                if decoder.feed(values_to_bits(info, n[keep])):
                     break
-        
-        return binary_to_message(binary_msg)
+
+        return decoder.message()
+
+    def capacity(self, image: np.ndarray) -> int:
+        """Number of bits `embed` can hide in `image`, delimiter or header included."""
+        if self._multichannel and is_multichannel(image):
+            return channels_capacity(map_channels(lambda k: self.capacity(image[..., k]), image.shape[2]),
+                                     self._framed)
+        img = _to_grayscale(image)
+        return sum(self._band_capacity(img, start, stop) for start, stop in row_bands(img.shape[0] - 1, img.shape[1]))
+
+    def embed(self, image: np.ndarray, message: Union[str, bytes, BitStream],
+              out: Optional[np.ndarray] = None, inplace: bool = False,
+              metrics: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, Dict[str, float]]]:
+        """
+        Returns the stego image, written into a new array, into `out` (a 2-D
+        uint8 array) when given, or into `image` itself with `inplace=True`.
+        With `metrics=True`, returns `(stego, metrics)` instead, see
+        `imstegan.metrics.compare`; the cover is the carrier as embedded
+        into, e.g. after grayscale conversion.
+        """
+        if self._multichannel and is_multichannel(image):
+            return embed_channels(self, image, message, out, inplace, metrics=metrics)
+        with stage('PVD.grayscale', image.shape[0] * image.shape[1]):
+            img = output_buffer(image, out, inplace, grayscale=True)
+        cover = img.copy() if metrics else None
+        with stage('PVD.bits'):
+            binary_msg = payload_bits(message, framed=self._framed)
+        # Capacity is only checked beforehand for the caller's arrays, a new
+        # one left half written is dropped along with the error
+        self._embed_rows(img, binary_msg, list(row_bands(img.shape[0] - 1, img.shape[1])),
+                         check=inplace or out is not None)
+        if cover is None:
+            return img
+        with stage('PVD.metrics', img.size):
+            return img, compare(cover, img)
+    
+    def extract(self, image: np.ndarray, as_bytes: bool = False) -> Union[str, bytes]:
+        if self._multichannel and is_multichannel(image):
+            data = extract_channels(self, image)
+        else:
+            data = self._extract_rows(image, first=16, largest=1024)
+        return data if as_bytes else bytes_to_message(data)
+
+    def embed_tiled(self, carrier: np.ndarray, message: Union[str, bytes, BitStream],
+                    tile_rows: int = 1024) -> np.ndarray:
+        """
+        Embeds in place into a 2-D uint8 carrier, e.g. an `np.memmap`, processing
+        `tile_rows` rows at a time. The result is the same as `embed`.
+        """
+        bands = list(chunk_bounds(carrier.shape[0] - 1, first=tile_rows, largest=tile_rows))
+        self._embed_rows(carrier, payload_bits(message, framed=self._framed), bands)
+        if isinstance(carrier, np.memmap):
+            carrier.flush()
+        return carrier
+
+    def extract_tiled(self, carrier: np.ndarray, tile_rows: int = 1024,
+                      as_bytes: bool = False) -> Union[str, bytes]:
+        """Extracts from a 2-D carrier, reading `tile_rows` rows at a time."""
+        data = self._extract_rows(carrier, first=tile_rows, largest=tile_rows)
+        return data if as_bytes else bytes_to_message(data)
 
 
 class AdaptivePVD():
@@ -112,96 +196,150 @@ class AdaptivePVD():
     """
     _pos = ((0, 0), (0, 2), (1, 0), (1, 2))
 
-    def __init__(self, **kwargs: Any):
-        pass
-
-    def _analyze_block(self, block):
-        gu = block[0, 1]
-        gb = block[1, 1]
-        ls, us, ns = [], [], []
-        for x, y in self._pos:
-            du = block[x, y] - gu
-            db = block[x, y] - gb
-            if du > 0 and db > 0:
-                l = max(gu + 1, gb + 1)
-                u = 255
-            elif du <= 0 and db <= 0:
-                l = 0
-                u = min(gu, gb)
-            elif du > 0 and db <= 0:
-                l = gu + 1
-                u = gb
-            else:
-                l = gb + 1
-                u = gu
-            n = min(math.floor(math.log2(abs(u - l + 1))), 3)
-            ls.append(l)
-            us.append(u)
-            ns.append(n)
-
-        return gu, ls, us, ns
-
-
-    def embed(self, image: np.ndarray, message: str) -> np.ndarray:
-        img = _to_grayscale(image).astype(np.short)
-        w, h = img.shape[:2]
-        message = message + '\0'
-        binary_msg = message_to_binary(message)
-        
-        for i in range(0, h - 2, 2):
-            if not binary_msg: break
-            for j in range(0, w - 3, 3):
-                block = img[i:i+2, j:j+3]
-                gu, ls, us, ns = self._analyze_block(block)
-                for (x, y), l, u, n in zip(self._pos, ls, us, ns):
-                    if not binary_msg: break
-                    if n < 1: continue
-                    b = int(binary_msg[:n], 2)
-                    binary_msg = binary_msg[n:]
-                    dmin = 256
-                    cmin = -1
-                    # NOTE: This can be solved efficiently with binary 
-                    # search + pre-computed table. Will come back later
-                    for c in range(l, u + 1):
-                        if (abs(c - gu) - b) % math.pow(2, n) == 0 and abs(c - block[x, y]) < dmin:
-                            dmin = abs(c - block[x, y])
-                            cmin = c
-                    block[x, y] = cmin
-
-        return img.astype(np.uint8)
-
-    def extract(self, image: np.ndarray) -> str:
+    def __init__(self, framed: bool = False, multichannel: bool = False, **kwargs: Any):
+        self._framed = framed
+        self._multichannel = multichannel
+
+    def _blocks(self, img):
+        """View of the block grid as `(rows, cols, 2, 3)`."""
+        # Block grid of the original implementation, which bounds block rows
+        # by the width and block columns by the height; blocks falling
+        # outside the image are left out.
+        rows = len(range(0, min(img.shape[1] - 2, img.shape[0] - 1), 2))
+        cols = len(range(0, min(img.shape[0] - 3, img.shape[1] - 2), 3))
+        return img[:2 * rows, :3 * cols].reshape(rows, 2, cols, 3).swapaxes(1, 2)
+
+    def _analyze_blocks(self, blocks):
+        """
+        Returns `gu` and the range `[l, u]` and capacity `n` of the four
+        corner pixels of every block, each shaped `(rows, cols, 4)`.
+        """
+        gu = blocks[..., 0, 1, None]
+        gb = blocks[..., 1, 1, None]
+        pixels = np.stack([blocks[..., x, y] for x, y in self._pos], axis=-1)
+        du = pixels - gu
+        db = pixels - gb
+        l = np.select(
+            [(du > 0) & (db > 0), (du <= 0) & (db <= 0), (du > 0) & (db <= 0)],
+            [np.maximum(gu, gb) + 1, 0, gu + 1],
+            gb + 1,
+        )
+        u = np.select(
+            [(du > 0) & (db > 0), (du <= 0) & (db <= 0), (du > 0) & (db <= 0)],
+            [255, np.minimum(gu, gb), gb],
+            gu,
+        )
+        size = u - l + 1
+        n = (size >= 2).astype(np.int64) + (size >= 4) + (size >= 8)
+
+        return np.broadcast_to(gu, n.shape), pixels, l, u, n
+
+    def _band_capacity(self, blocks, start, stop):
+        """Number of bits the block rows `[start, stop)` hold."""
+        return int(self._analyze_blocks(blocks[start:stop].astype(np.short))[-1].sum())
+
+    def _embed_blocks(self, img, binary_msg, check=True):
+        """
+        Embeds into the uint8 image `img` in place, a band of block rows at a
+        time, up to the end of the message. With `check`, raises `ValueError`
+        before writing anything if the message does not fit.
+        """
+        blocks = self._blocks(img)
+        bands = list(row_bands(blocks.shape[0], 6 * blocks.shape[1]))
+        if check:
+            with stage('AdaptivePVD.analyze'):
+                check_capacity(lambda start, stop: self._band_capacity(blocks, start, stop), bands, len(binary_msg))
+        offset = 0
+        for start, stop in bands:
+            if offset >= len(binary_msg):
+                break
+            with stage('AdaptivePVD.analyze') as s:
+                band = blocks[start:stop]
+                gu, pixels, l, u, n = (x.reshape(-1) for x in self._analyze_blocks(band.astype(np.short)))
+                s.touch(6 * band.shape[0] * band.shape[1])
+
+            with stage('AdaptivePVD.write') as s:
+                # Bit offset of every corner pixel, pixels past the end of the message are unused
+                offsets = offset + np.cumsum(n) - n
+                used = np.flatnonzero((n > 0) & (offsets < len(binary_msg)))
+                b = bits_to_values(binary_msg[offset:], n[used])
+                offset += n[used].sum()
+                gu, p, l, u, m = gu[used], pixels[used], l[used], u[used], 2 ** n[used]
+
+                # Closed form of the nearest c in [l, u] with (|c - gu| - b) % 2^n == 0:
+                # values above gu need c = gu + b (mod 2^n), values below c = gu - b.
+                # Take the candidates right below and above p, ties go to the lower.
+                residue = np.where(p > gu, gu + b, gu - b) % m
+                below = p - (p - residue) % m
+                above = below + m
+                nearest = np.where((below >= l) & ((above > u) | (p - below <= above - p)), below, above)
+
+                block, corner = np.divmod(used, len(self._pos))
+                row, col = np.divmod(block, blocks.shape[1])
+                pos = np.array(self._pos)
+                img[2 * (start + row) + pos[corner, 0], 3 * col + pos[corner, 1]] = nearest
+                s.touch(len(used))
+
+        if offset < len(binary_msg):
+            raise ValueError(f"Message is too large for the image: needs {len(binary_msg)} bits, "
+                             f"capacity is {offset}")
+
+
+    def capacity(self, image: np.ndarray) -> int:
+        """Number of bits `embed` can hide in `image`, delimiter or header included."""
+        if self._multichannel and is_multichannel(image):
+            return channels_capacity(map_channels(lambda k: self.capacity(image[..., k]), image.shape[2]),
+                                     self._framed)
+        blocks = self._blocks(_to_grayscale(image))
+        bands = row_bands(blocks.shape[0], 6 * blocks.shape[1])
+        return sum(self._band_capacity(blocks, start, stop) for start, stop in bands)
+
+    def embed(self, image: np.ndarray, message: Union[str, bytes, BitStream],
+              out: Optional[np.ndarray] = None, inplace: bool = False,
+              metrics: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, Dict[str, float]]]:
+        """
+        Returns the stego image, written into a new array, into `out` (a 2-D
+        uint8 array) when given, or into `image` itself with `inplace=True`.
+        With `metrics=True`, returns `(stego, metrics)` instead, see
+        `imstegan.metrics.compare`; the cover is the carrier as embedded
+        into, e.g. after grayscale conversion.
+        """
+        if self._multichannel and is_multichannel(image):
+            return embed_channels(self, image, message, out, inplace, metrics=metrics)
+        with stage('AdaptivePVD.grayscale', image.shape[0] * image.shape[1]):
+            img = output_buffer(image, out, inplace, grayscale=True)
+        cover = img.copy() if metrics else None
+        with stage('AdaptivePVD.bits'):
+            binary_msg = payload_bits(message, framed=self._framed)
+        # Capacity is only checked beforehand for the caller's arrays, a new
+        # one left half written is dropped along with the error
+        self._embed_blocks(img, binary_msg, check=inplace or out is not None)
+        if cover is None:
+            return img
+        with stage('AdaptivePVD.metrics', img.size):
+            return img, compare(cover, img)
+
+    def extract(self, image: np.ndarray, as_bytes: bool = False) -> Union[str, bytes]:
+        if self._multichannel and is_multichannel(image):
+            data = extract_channels(self, image)
+            return data if as_bytes else bytes_to_message(data)
         if image.ndim == 3 and image.shape[2] == 1:
             image = image.squeeze()
         assert image.ndim == 2, "Image must be grayscale"
         img = image.astype(np.short)
-        w, h = img.shape[:2]
-        binary_msg = ''
-        completed = False
-        
-        for i in range(0, h - 2, 2):
-            if completed: break
-            for j in range(0, w - 3, 3):
-                if completed: break
-                block = img[i:i+2, j:j+3]
-                gu, _, _, ns = self._analyze_block(block)
-                for (x, y), n in zip(self._pos, ns):
-                    if completed: break
-                    info = None
-                    # NOTE: This too can be solved more efficiently
-                    for b in range(2**n):
-                        if (b - abs(block[x, y] - gu)) % math.pow(2, n) == 0:
-                            info = b
-                            break
-                    info = f"{b:b}"
-                    if len(info) < n:
-                        info = "0" * (n - len(info)) + info
-                    binary_msg += info
-                    # End of message check
-                    rem = len(binary_msg) % 8
-                    if binary_msg[-rem-8:-rem] == "00000000":
-                        completed = True
-                        binary_msg = binary_msg[:-rem-8]
-                        break
-
-        return binary_to_message(binary_msg)
\ No newline at end of file
+        blocks = self._blocks(img)
+        # Every corner pixel holds at most 3 bits
+        decoder = payload_decoder(framed=self._framed, capacity=12 * blocks.shape[0] * blocks.shape[1])
+
+        # Extract a band of block rows at a time until the end of message
+        for start, stop in chunk_bounds(blocks.shape[0], first=8, largest=512):
+            with stage('AdaptivePVD.analyze', 6 * (stop - start) * blocks.shape[1]):
+                gu, pixels, _, _, n = (x.reshape(-1) for x in self._analyze_blocks(blocks[start:stop]))
+            with stage('AdaptivePVD.decode'):
+                keep = n > 0
+                info = np.abs(pixels[keep] - gu[keep]) % 2 ** n[keep]
+                if decoder.feed(values_to_bits(info, n[keep])):
+                    break
+
+        data = decoder.message()
+        return data if as_bytes else bytes_to_message(data)
@@ -1,5 +1,39 @@
-from .LSB import LSB
-from .PVD import *
-from .LSBM import *
-from .DCT import *
-from .edge import *
\ No newline at end of file
+import importlib
+
+
+# Module defining every algorithm, relative to this package. Modules are only
+# imported when one of their algorithms is first used, so that e.g. numba and
+# OpenCV are not loaded by programs that only need LSB.
+_REGISTRY = {
+    "LSB": ".LSB",
+    "LSBM": ".LSBM",
+    "PVD": ".PVD",
+    "AdaptivePVD": ".PVD",
+    "DCTScale": ".DCT",
+    "SobelLSB": ".edge",
+}
+
+__all__ = list(_REGISTRY)
+
+
+def load(name):
+    """Returns the algorithm class called `name`, importing its module if needed."""
+    if name not in _REGISTRY:
+        raise AttributeError(f"Unknown algorithm: {name}")
+    module = importlib.import_module(_REGISTRY[name], __name__)
+    # Importing the module binds its name in this package, LSB, LSBM and PVD
+    # must still refer to the classes
+    for other, path in _REGISTRY.items():
+        if path == _REGISTRY[name]:
+            globals()[other] = getattr(module, other)
+    return globals()[name]
+
+
+def __getattr__(name):
+    if name in _REGISTRY:
+        return load(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_REGISTRY))
\ No newline at end of file
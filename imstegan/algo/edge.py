@@ -1,14 +1,21 @@
 import warnings
-from typing import Any
+from typing import Any, Dict, Optional, Tuple, Union
 
 import numpy as np
 
-from ..utils import message_to_binary, binary_to_message, rgb_to_gray, conv2d
+from ..utils import (BitStream, payload_bits, bytes_to_message, values_to_bits, bits_to_values,
+                     rgb_to_gray, gradient_magnitude, chunk_bounds, row_bands, check_capacity, payload_decoder,
+                     output_buffer, stage, is_multichannel, map_channels, embed_channels, extract_channels,
+                     channels_capacity)
+from ..metrics import compare
 
 
 __all__ = ["SobelLSB"]
 
 
+_SOBEL = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
+
+
 def _to_grayscale(image):
     if image.ndim > 2:
         if image.shape[2] == 3:
@@ -26,43 +33,135 @@ class SobelLSB():
     """Edge-based LSB embedding using Sobel kernel, idea described in: 
     `"Edge-based image steganography", Saiful Islam, Mangat R Modi and Phalguni Gupta`
     """
-    def __init__(self, n_bits: int = 2, sobel_threshold: float = 0.5, **kwargs: Any) -> None:
+    def __init__(self, n_bits: int = 2, sobel_threshold: float = 0.5, framed: bool = False,
+                 multichannel: bool = False, **kwargs: Any) -> None:
         self._n_bits = n_bits
         self._threshold = sobel_threshold
+        self._framed = framed
+        self._multichannel = multichannel
         pass
 
     def _sobel_magnitude(self, image):
-        Gx = conv2d(image, np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]))
-        Gy = conv2d(image, np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]]))
-        return np.sqrt(Gx ** 2 + Gy ** 2)
+        # float64 like the original two-kernel computation, so that the same
+        # pixels pass the threshold
+        return gradient_magnitude(image, _SOBEL)
+
+    def _edge_positions(self, img, start=0, stop=None):
+        """Flat indices of the edge pixels in rows `[start, stop)`, in raster order."""
+        stop = img.shape[0] if stop is None else stop
+        # One extra row on each side so that the band sees its real neighbours
+        lo, hi = max(start - 1, 0), min(stop + 1, img.shape[0])
+        band = img[lo:hi]
+        shift = 8 - self._n_bits
+        edge_mask = self._sobel_magnitude(((band >> shift) << shift)/255.)[start - lo:stop - lo]
+        return np.flatnonzero(edge_mask >= self._threshold) + start * img.shape[1]
+
+    def _band_capacity(self, img, start, stop):
+        """Number of bits the edge pixels of rows `[start, stop)` hold."""
+        return len(self._edge_positions(img, start, stop)) * self._n_bits
+
+    def _embed_rows(self, img, binary_msg, bands, check=True):
+        """
+        Embeds into the uint8 image `img` in place, a band of rows of the list
+        `bands` at a time, up to the end of the message. With `check`, raises
+        `ValueError` before writing anything if the message does not fit.
+        """
+        # Number of edge pixels the message takes
+        groups = -(-len(binary_msg) // self._n_bits)
+        if check:
+            # Edges only depend on the bits above those written, so writing
+            # a band does not change the edges of the next
+            with stage('SobelLSB.edges'):
+                check_capacity(lambda start, stop: self._band_capacity(img, start, stop), bands,
+                               groups * self._n_bits)
+        offset = 0
+        for start, stop in bands:
+            if offset >= groups:
+                break
+            with stage('SobelLSB.edges', (stop - start) * img.shape[1]):
+                edge_loc = self._edge_positions(img, start, stop)[:groups - offset]
+            with stage('SobelLSB.bits'):
+                values = bits_to_values(binary_msg[offset * self._n_bits:(offset + len(edge_loc)) * self._n_bits],
+                                        self._n_bits)
+            with stage('SobelLSB.write', len(edge_loc)):
+                rows, cols = np.divmod(edge_loc, img.shape[1])
+                img[rows, cols] = (img[rows, cols] >> self._n_bits) << self._n_bits | values
+            offset += len(edge_loc)
+
+        if offset < groups:
+            raise ValueError(f"Message is too large for the image: needs {len(binary_msg)} bits, "
+                             f"capacity is {offset * self._n_bits}")
 
-    def embed(self, image: np.ndarray, message: str) -> np.ndarray:
+    def _extract_rows(self, image, bands):
+        flat = image.reshape(-1)
+        mask = (1 << self._n_bits) - 1
+        decoder = payload_decoder(framed=self._framed, capacity=flat.size * self._n_bits)
+        for band_start, band_stop in bands:
+            with stage('SobelLSB.edges', (band_stop - band_start) * image.shape[1]):
+                edge_loc = self._edge_positions(image, band_start, band_stop)
+            for start, stop in chunk_bounds(len(edge_loc), limit=lambda: decoder.needed(self._n_bits)):
+                with stage('SobelLSB.read', stop - start):
+                    info = flat[edge_loc[start:stop]] & mask
+                with stage('SobelLSB.decode'):
+                    if decoder.feed(values_to_bits(info, self._n_bits)):
+                        return decoder.message()
+
+        return decoder.message()
+
+    def capacity(self, image: np.ndarray) -> int:
+        """Number of bits `embed` can hide in `image`, delimiter or header included."""
+        if self._multichannel and is_multichannel(image):
+            return channels_capacity(map_channels(lambda k: self.capacity(image[..., k]), image.shape[2]),
+                                     self._framed)
         img = _to_grayscale(image).astype(np.uint8)
-        binary_msg = message_to_binary(message + '\0')
-        edge_mask = self._sobel_magnitude(((img >> (8 - self._n_bits)) << (8 - self._n_bits))/255.)
-        edge_loc = np.where(edge_mask >= self._threshold)
-        for x,y in zip(*edge_loc):
-            if not binary_msg: break
-            b = int(binary_msg[:self._n_bits], 2)
-            binary_msg = binary_msg[self._n_bits:]
-            img[x, y] = (img[x, y] >> self._n_bits) << self._n_bits | b
-        
-        return img
+        return sum(self._band_capacity(img, start, stop) for start, stop in row_bands(*img.shape))
+
+    def embed(self, image: np.ndarray, message: Union[str, bytes, BitStream],
+              out: Optional[np.ndarray] = None, inplace: bool = False,
+              metrics: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, Dict[str, float]]]:
+        """
+        Returns the stego image, written into a new array, into `out` (a 2-D
+        uint8 array) when given, or into `image` itself with `inplace=True`.
+        With `metrics=True`, returns `(stego, metrics)` instead, see
+        `imstegan.metrics.compare`; the cover is the carrier as embedded
+        into, e.g. after grayscale conversion.
+        """
+        if self._multichannel and is_multichannel(image):
+            return embed_channels(self, image, message, out, inplace, metrics=metrics)
+        with stage('SobelLSB.grayscale', image.shape[0] * image.shape[1]):
+            img = output_buffer(image, out, inplace, grayscale=True)
+        cover = img.copy() if metrics else None
+        # Capacity is only checked beforehand for the caller's arrays, a new
+        # one left half written is dropped along with the error
+        self._embed_rows(img, payload_bits(message, framed=self._framed), list(row_bands(*img.shape)),
+                         check=inplace or out is not None)
+
+        if cover is None:
+            return img
+        with stage('SobelLSB.metrics', img.size):
+            return img, compare(cover, img)
     
-    def extract(self, image: np.ndarray) -> str:
-        binary_msg = ''
-        completed = False
-        edge_mask = self._sobel_magnitude(((image >> (8 - self._n_bits)) << (8 - self._n_bits))/255.)
-        edge_loc = np.where(edge_mask >= self._threshold)
-        for x,y in zip(*edge_loc):
-            if completed: break
-            b = image[x, y] & ((1 << self._n_bits) - 1)
-            binary_msg += bin(b)[2:].zfill(self._n_bits)
-            # End of message check
-            rem = len(binary_msg) % 8
-            if binary_msg[-rem-8:-rem] == "00000000":
-                completed = True
-                binary_msg = binary_msg[:-rem-8]
-                break
-        
-        return binary_to_message(binary_msg)
\ No newline at end of file
+    def extract(self, image: np.ndarray, as_bytes: bool = False) -> Union[str, bytes]:
+        if self._multichannel and is_multichannel(image):
+            data = extract_channels(self, image)
+        else:
+            data = self._extract_rows(image, row_bands(*image.shape[:2]))
+        return data if as_bytes else bytes_to_message(data)
+
+    def embed_tiled(self, carrier: np.ndarray, message: Union[str, bytes, BitStream],
+                    tile_rows: int = 1024) -> np.ndarray:
+        """
+        Embeds in place into a 2-D uint8 carrier, e.g. an `np.memmap`, processing
+        `tile_rows` rows at a time. The result is the same as `embed`.
+        """
+        bands = list(chunk_bounds(carrier.shape[0], first=tile_rows, largest=tile_rows))
+        self._embed_rows(carrier, payload_bits(message, framed=self._framed), bands)
+        if isinstance(carrier, np.memmap):
+            carrier.flush()
+        return carrier
+
+    def extract_tiled(self, carrier: np.ndarray, tile_rows: int = 1024,
+                      as_bytes: bool = False) -> Union[str, bytes]:
+        """Extracts from a 2-D carrier, reading `tile_rows` rows at a time."""
+        data = self._extract_rows(carrier, chunk_bounds(carrier.shape[0], first=tile_rows, largest=tile_rows))
+        return data if as_bytes else bytes_to_message(data)
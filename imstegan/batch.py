@@ -0,0 +1,330 @@
+"""Batch embedding and extraction over a pool of worker processes.
+
+Images are handed to the workers through `multiprocessing.shared_memory`
+instead of being pickled, and every worker keeps a single, already warmed-up
+algorithm instance (numba kernels compiled, lookup tables built) for its
+whole lifetime. `process_files` does the same for image files, which the
+workers read and write themselves.
+"""
+import glob
+import itertools
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+from typing import Any, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from .io import decode, encode
+from .utils import bytes_to_message, message_to_bytes
+
+
+__all__ = ["embed_many", "extract_many", "capacity_many", "expand_inputs", "process_files"]
+
+
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.tif', '.tiff', '.ppm', '.pgm', '.jpg', '.jpeg', '.webp')
+
+
+# Algorithm instance owned by the current worker process
+_algorithm = None
+
+
+def _share(array):
+    """Copies `array` into a new shared memory block."""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(handle):
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(algorithm, shape, dtype):
+    global _algorithm
+    _algorithm = algorithm
+    # Warm up on a small image shaped like the real ones, so JIT compilation
+    # and other first-call costs are paid once per worker, not per image
+    shape = tuple(min(s, 64) for s in shape[:2]) + tuple(shape[2:])
+    image = np.random.default_rng(0).integers(0, 256, shape).astype(dtype)
+    try:
+        # e.g. the grayscale conversion warning, which concerns the real images only
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            _algorithm.extract(_algorithm.embed(image, 'warm-up'))
+    except Exception:
+        pass
+
+
+def _embed_task(index, handle, message):
+    shm, image = _attach(handle)
+    try:
+        # The result may be a view of the input, copy it out before closing
+        out, out_handle = _share(_algorithm.embed(image, message))
+        out.close()
+    finally:
+        del image
+        shm.close()
+    return index, out_handle
+
+
+def _extract_task(index, handle, kwargs):
+    shm, image = _attach(handle)
+    try:
+        return index, _algorithm.extract(image, **kwargs)
+    finally:
+        del image
+        shm.close()
+
+
+def _capacity_task(index, handle):
+    shm, image = _attach(handle)
+    try:
+        return index, _algorithm.capacity(image)
+    finally:
+        del image
+        shm.close()
+
+
+def _run(algorithm, tasks, submit, collect, workers, ordered):
+    """
+    Feeds `(index, image, *args)` tasks to a warmed-up pool, keeping at most
+    two images per worker in shared memory, and yields collected results.
+    """
+    tasks = iter(tasks)
+    first = next(tasks, None)
+    if first is None:
+        return
+    tasks = itertools.chain([first], tasks)
+    image = np.asarray(first[1])
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                               initargs=(algorithm, image.shape, image.dtype))
+    pending = {}
+    done = {}
+    next_index = 0
+    try:
+        while True:
+            for index, image, *args in itertools.islice(tasks, 2 * workers - len(pending)):
+                shm, handle = _share(np.asarray(image))
+                pending[pool.submit(submit, index, handle, *args)] = shm
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                shm = pending.pop(future)
+                shm.close()
+                shm.unlink()
+                index, result = future.result()
+                done[index] = collect(result)
+            if not ordered:
+                yield from done.items()
+                done.clear()
+            while next_index in done:
+                yield done.pop(next_index)
+                next_index += 1
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        # Release the shared memory of tasks that were still in flight
+        for future, shm in pending.items():
+            shm.close()
+            shm.unlink()
+            if not future.cancelled() and future.exception() is None:
+                collect(future.result()[1])
+
+
+def _collect_image(handle):
+    shm, image = _attach(handle)
+    result = image.copy()
+    del image
+    shm.close()
+    shm.unlink()
+    return result
+
+
+def embed_many(algorithm: Any, images: Iterable[np.ndarray], messages: Iterable[Any],
+               workers: Optional[int] = None, ordered: bool = True) -> Iterator[Any]:
+    """
+    Embeds `messages[i]` into `images[i]` for every pair, using a pool of
+    `workers` processes that each hold a copy of `algorithm`.
+
+    Images are consumed lazily, so `images` and `messages` may be generators.
+    Yields stego images in input order when `ordered`, otherwise
+    `(index, stego_image)` pairs as soon as they are done.
+    """
+    tasks = ((i, image, message) for i, (image, message) in enumerate(zip(images, messages)))
+    return _run(algorithm, tasks, _embed_task, _collect_image, workers, ordered)
+
+
+def extract_many(algorithm: Any, images: Iterable[np.ndarray], workers: Optional[int] = None,
+                 ordered: bool = True, **kwargs: Any) -> Iterator[Any]:
+    """
+    Extracts the message of every image, using a pool of `workers` processes
+    that each hold a copy of `algorithm`. Keyword arguments are passed on to
+    `extract`.
+
+    Yields messages in input order when `ordered`, otherwise
+    `(index, message)` pairs as soon as they are done.
+    """
+    tasks = ((i, image, kwargs) for i, image in enumerate(images))
+    return _run(algorithm, tasks, _extract_task, lambda message: message, workers, ordered)
+
+
+def capacity_many(algorithm: Any, images: Iterable[np.ndarray], workers: Optional[int] = None,
+                  ordered: bool = True) -> Iterator[Any]:
+    """
+    Computes `algorithm.capacity` of every image, using a pool of `workers`
+    processes that each hold a copy of `algorithm`.
+
+    Yields capacities in input order when `ordered`, otherwise
+    `(index, capacity)` pairs as soon as they are done.
+    """
+    tasks = ((i, image) for i, image in enumerate(images))
+    return _run(algorithm, tasks, _capacity_task, lambda capacity: capacity, workers, ordered)
+
+
+def expand_inputs(inputs: Iterable[str] = (), input_list: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily expands files, directories (searched recursively for images) and
+    glob patterns, then the paths listed one per line in `input_list`.
+    Yields `(path, name)` pairs, `name` being the path relative to its
+    directory argument or to the leading directories of its pattern without
+    wildcards, or the file name otherwise.
+    """
+    def listed():
+        yield from inputs
+        if input_list:
+            with open(input_list) as f:
+                yield from (line.strip() for line in f if line.strip())
+
+    for item in listed():
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for file in sorted(files):
+                    if file.lower().endswith(IMAGE_EXTENSIONS):
+                        path = os.path.join(root, file)
+                        yield path, os.path.relpath(path, item)
+        elif glob.has_magic(item):
+            # Matches keep their path below the part of the pattern without
+            # wildcards, e.g. d/a/x.png and d/b/x.png of d/**/*.png
+            root = item
+            while glob.has_magic(root):
+                root = os.path.dirname(root)
+            for path in sorted(glob.iglob(item, recursive=True)):
+                if os.path.isfile(path):
+                    yield path, os.path.relpath(path, root or os.curdir)
+        else:
+            # Missing files are reported by the worker like any other failure
+            yield item, os.path.basename(item)
+
+
+def _file_task(path, output, message, encoding):
+    """Embeds `message` into, or extracts from when it is None, one image file."""
+    start = time.perf_counter()
+    record = {'path': path}
+    try:
+        # Like the CLI, LSBM carriers are read as grayscale
+        image = decode(path, 'gray' if type(_algorithm).__name__ == 'LSBM' else None)
+        if message is None:
+            data = _algorithm.extract(image, as_bytes=True)
+            record['bytes'] = len(data)
+            if output:
+                os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+                with open(output, 'wb') as f:
+                    f.write(data)
+                record['output'] = output
+            else:
+                record['message'] = bytes_to_message(data)
+        else:
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+            encode(_algorithm.embed(image, message), output, **encoding)
+            record['bytes'] = len(message_to_bytes(message))
+            record['output'] = output
+        record['status'] = 'ok'
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+    record['elapsed'] = time.perf_counter() - start
+    return record
+
+
+def process_files(algorithm: Any, inputs: Iterable[Tuple[str, str]], message: Any = None,
+                  output_dir: Optional[str] = None, workers: Optional[int] = None, compress_level: int = 6,
+                  strategy: str = 'default') -> Iterator[dict]:
+    """
+    Embeds `message` into, or extracts from when it is None, every image of
+    `inputs`, `(path, name)` pairs as yielded by `expand_inputs`. Workers
+    read and write the files themselves.
+
+    Stego images are saved as PNG under `output_dir` with the relative
+    `name` of their input, encoded with `compress_level` and `strategy` (see
+    `imstegan.io.encode`); extracted messages are saved there as `.txt`
+    files, or returned in the records when `output_dir` is None.
+
+    Yields one manifest record per file as soon as it is done, with its
+    `path`, `status` (`'ok'` or `'error'`), `bytes` embedded or extracted,
+    `elapsed` seconds and `output` path or `message`. Failures are recorded
+    with their `error` and do not stop the run. An input whose output path
+    is already the one of an earlier input, e.g. files of the same name
+    given one by one, is recorded as a failure too and left out rather than
+    overwriting that output.
+    """
+    if message is not None and output_dir is None:
+        raise ValueError("Embedding files needs an output directory")
+
+    extension = '.txt' if message is None else '.png'
+    encoding = {'compress_level': compress_level, 'strategy': strategy}
+
+    # Output path of every input so far, and records of the inputs left out
+    claimed, skipped = {}, []
+
+    def tasks():
+        for path, name in inputs:
+            output = None if output_dir is None else os.path.join(output_dir, os.path.splitext(name)[0] + extension)
+            if output is not None:
+                key = os.path.normcase(os.path.normpath(output))
+                if key in claimed:
+                    skipped.append({'path': path, 'status': 'error', 'elapsed': None,
+                                    'error': f"ValueError: Output {output} is also the one of {claimed[key]}"})
+                    continue
+                claimed[key] = path
+            yield path, output, message, encoding
+
+    def drain():
+        yield from skipped
+        skipped.clear()
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_worker(algorithm, (64, 64, 3), np.uint8)
+        for task in tasks():
+            yield from drain()
+            yield _file_task(*task)
+        yield from drain()
+        return
+
+    tasks = tasks()
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(algorithm, (64, 64, 3), np.uint8))
+    pending = {}
+    try:
+        while True:
+            for task in itertools.islice(tasks, 2 * workers - len(pending)):
+                pending[pool.submit(_file_task, *task)] = task[0]
+            yield from drain()
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception as e:
+                    # The worker itself died, e.g. killed by the OS
+                    yield {'path': path, 'status': 'error', 'error': f"{type(e).__name__}: {e}", 'elapsed': None}
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,189 @@
+"""Benchmarks of every algorithm over image and payload sizes.
+
+Run with `python -m imstegan.bench`; results are written as JSON so runs on
+different commits can be compared.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+import imstegan
+
+
+ALGORITHMS = ['LSB', 'LSBM', 'PVD', 'AdaptivePVD', 'DCTScale', 'SobelLSB']
+PERCENTILES = [50, 90, 99]
+
+
+def synthetic_carrier(height, width, channels=None, seed=0):
+    """
+    Photo-like test image: smooth waves and gradients plus sensor noise, so
+    that edge and difference based algorithms see realistic capacities.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(height, width)
+    shape = (height, width) if channels is None else (height, width, channels)
+    image = np.empty(shape, dtype=np.float64)
+    for c in range(1 if channels is None else channels):
+        fx, fy, phase = rng.uniform(2, 12, 3)
+        plane = 128 + 60 * np.sin(fx * x + phase) * np.cos(fy * y) + 40 * (x - y)
+        plane += rng.normal(0, 6, (height, width))
+        if channels is None:
+            image[...] = plane
+        else:
+            image[..., c] = plane
+    return image.clip(0, 255).astype(np.uint8)
+
+
+def _payload(n_bytes, seed):
+    # No NUL bytes, they would end the message early
+    return np.random.default_rng(seed).integers(1, 256, n_bytes, dtype=np.uint8).tobytes()
+
+
+def _summary(times):
+    times = np.asarray(times)
+    summary = {'min': float(times.min()), 'mean': float(times.mean())}
+    for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+        summary[f'p{p}'] = float(value)
+    return summary
+
+
+def _peak_memory(fn, *args):
+    """Peak memory in bytes allocated by one call of `fn`."""
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _first_call(algorithm):
+    """Seconds taken by the first embed and extract, including numba JIT compilation."""
+    image = synthetic_carrier(64, 64, 3)
+    start = time.perf_counter()
+    steg = algorithm.embed(image, 'warm-up')
+    embed = time.perf_counter() - start
+    start = time.perf_counter()
+    algorithm.extract(steg)
+    return {'embed': embed, 'extract': time.perf_counter() - start}
+
+
+def run_case(algorithm, image, payload, repeat):
+    """Times `repeat` embeds and extracts of `payload` into `image`."""
+    embed_times, extract_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        steg = algorithm.embed(image, payload)
+        embed_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        message = algorithm.extract(steg, as_bytes=True)
+        extract_times.append(time.perf_counter() - start)
+
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+    result = {'correct': message == payload}
+    for name, times, fn, args in [('embed', embed_times, algorithm.embed, (image, payload)),
+                                  ('extract', extract_times, algorithm.extract, (steg,))]:
+        median = float(np.median(times))
+        result[name] = {
+            'latency_s': _summary(times),
+            'payload_mb_per_s': len(payload) / 1e6 / median,
+            'megapixels_per_s': megapixels / median,
+            'peak_memory_bytes': _peak_memory(fn, *args),
+        }
+    return result
+
+
+def run(algorithms=ALGORITHMS, sizes=((256, 256), (1024, 1024)), modes=('gray', 'rgb'),
+        fractions=(0.0, 0.1, 0.5, 0.95), repeat=5, seed=0, log=None):
+    """
+    Runs every combination of algorithm, carrier size, color mode and
+    payload size, the latter given as fractions of the carrier capacity
+    (0 meaning a 16-byte message). Returns a JSON serializable dict.
+    """
+    results = []
+    for name in algorithms:
+        algorithm = getattr(imstegan, name)()
+        entry = {'algorithm': name, 'first_call_s': _first_call(algorithm), 'cases': []}
+        for height, width in sizes:
+            for mode in modes:
+                image = synthetic_carrier(height, width, 3 if mode == 'rgb' else None, seed)
+                if name == 'LSB' and image.ndim == 2:
+                    # LSB expects a channel axis
+                    image = image[..., None]
+                capacity = (algorithm.capacity(image) - 8) // 8
+                for fraction in fractions:
+                    n_bytes = min(int(capacity * fraction) if fraction else 16, capacity)
+                    case = {'height': height, 'width': width, 'mode': mode,
+                            'capacity_bytes': capacity, 'payload_bytes': n_bytes}
+                    case.update(run_case(algorithm, image, _payload(n_bytes, seed), repeat))
+                    entry['cases'].append(case)
+                    if log:
+                        log(f"{name:12s} {height}x{width} {mode:4s} {n_bytes:>10d} B  "
+                            f"embed {case['embed']['latency_s']['p50'] * 1e3:9.2f} ms  "
+                            f"extract {case['extract']['latency_s']['p50'] * 1e3:9.2f} ms")
+        results.append(entry)
+
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'numba': numba_version,
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def _size(text):
+    height, _, width = text.partition('x')
+    return int(height), int(width or height)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark imstegan algorithms')
+    parser.add_argument('--algorithms', type=str, nargs='+', default=ALGORITHMS, help='Algorithms to be benchmarked')
+    parser.add_argument('--sizes', type=_size, nargs='+', default=[(256, 256), (1024, 1024)],
+                        help='Carrier sizes as HEIGHTxWIDTH (or a single number for squares)')
+    parser.add_argument('--modes', type=str, nargs='+', default=['gray', 'rgb'], choices=['gray', 'rgb'],
+                        help='Carrier color modes')
+    parser.add_argument('--fractions', type=float, nargs='+', default=[0.0, 0.1, 0.5, 0.95],
+                        help='Payload sizes as fractions of the capacity, 0 for a 16-byte message')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per case')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for carriers and payloads')
+    parser.add_argument('--output', type=str, default=None, help='Output path for the JSON results, stdout if omitted')
+    parser.add_argument('--quiet', action='store_true', help='Do not print progress')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log = None if args.quiet else lambda line: print(line, file=sys.stderr)
+    with warnings.catch_warnings():
+        # Grayscale algorithms warn about every RGB carrier
+        warnings.simplefilter('ignore')
+        results = run(args.algorithms, args.sizes, args.modes, args.fractions, args.repeat, args.seed, log)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Image decoding and encoding shared by the CLI, batch and asyncio paths.
+
+`decode` reads a file path, encoded bytes, a memoryview or a binary file into
+a uint8 array, optionally a preallocated one that is reused across images.
+Channel order is always explicit: arrays are RGB(A), or BGR with
+`mode='bgr'` (the layout of OpenCV), and grayscale images are 2-D.
+
+`encode` is lossless only and exposes its speed/size trade-off: PNG with a
+zlib level and strategy, uncompressed TIFF, or binary PPM/PGM, which costs
+little more than a memory copy. Binary PPM/PGM files are also decoded
+without an intermediate copy, straight into the output array.
+"""
+import os
+import re
+from io import BytesIO
+from typing import BinaryIO, Optional, Union
+
+import numpy as np
+
+
+__all__ = ["decode", "encode", "MODES", "FORMATS", "PNG_STRATEGIES"]
+
+
+# Pixel layouts `decode` can produce and the Pillow mode decoded to
+MODES = {'rgb': 'RGB', 'bgr': 'RGB', 'gray': 'L'}
+
+# Lossless formats `encode` can produce and their file extensions
+FORMATS = {'png': ('.png',), 'tiff': ('.tif', '.tiff'), 'ppm': ('.ppm', '.pgm', '.pnm'), 'bmp': ('.bmp',)}
+
+# zlib strategies for PNG, 'default' being the one Pillow picks. 'huffman'
+# skips string matching, which is much faster and, on noisy photos, about as
+# small as the default
+PNG_STRATEGIES = {'default': -1, 'huffman': 2, 'rle': 3, 'fixed': 4}
+
+_PIL_FORMATS = {'png': 'PNG', 'tiff': 'TIFF', 'ppm': 'PPM', 'bmp': 'BMP'}
+
+# Binary PGM (P5) and PPM (P6) header, comments allowed between fields
+_SEPARATOR = rb'(?:\s|#[^\r\n]*[\r\n])+'
+_NETPBM_HEADER = re.compile(rb'P([56])' + 3 * (_SEPARATOR + rb'(\d+)') + rb'\s')
+_HEADER_SIZE = 1024
+
+Source = Union[str, os.PathLike, bytes, bytearray, memoryview, BinaryIO]
+Target = Union[str, os.PathLike, BinaryIO]
+
+
+def _check_mode(mode):
+    if mode is not None and mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {list(MODES)} or None")
+
+
+def _output(out, shape):
+    if out is None:
+        return np.empty(shape, dtype=np.uint8)
+    if out.dtype != np.uint8 or out.shape != shape:
+        raise ValueError(f"out must be a uint8 array of shape {shape}")
+    return out
+
+
+def _store(pixels, mode, out):
+    """Copies decoded `pixels`, in RGB order, into `out` or a new array."""
+    out = _output(out, pixels.shape)
+    np.copyto(out, pixels[..., ::-1] if mode == 'bgr' else pixels)
+    return out
+
+
+def _netpbm(header, mode):
+    """Shape and pixel offset of a binary PGM/PPM that can be read as is in `mode`."""
+    match = _NETPBM_HEADER.match(header)
+    if match is None:
+        return None
+    gray = match[1] == b'5'
+    width, height, maxval = int(match[2]), int(match[3]), int(match[4])
+    if maxval > 255 or (mode is not None and gray != (mode == 'gray')):
+        return None
+    return ((height, width) if gray else (height, width, 3)), match.end()
+
+
+def _decode_file(f, mode, out):
+    start = f.tell()
+    header = _netpbm(f.read(_HEADER_SIZE), mode)
+    if header is not None:
+        shape, offset = header
+        out = _output(out, shape)
+        target = out if out.flags.c_contiguous else np.empty(shape, dtype=np.uint8)
+        f.seek(start + offset)
+        if f.readinto(memoryview(target).cast('B')) == target.nbytes:
+            if mode == 'bgr':
+                target[...] = target[..., ::-1]
+            if target is not out:
+                np.copyto(out, target)
+            return out
+        # Truncated, let Pillow report it
+    f.seek(start)
+
+    from PIL import Image
+    with Image.open(f) as image:
+        if mode is not None:
+            pil_mode = MODES[mode]
+        elif image.mode in ('L', 'RGB', 'RGBA'):
+            pil_mode = image.mode
+        elif 'A' in image.getbands() or 'transparency' in image.info:
+            pil_mode = 'RGBA'
+        else:
+            # Palette, bilevel, 16-bit, CMYK, ... images
+            pil_mode = 'L' if Image.getmodebase(image.mode) == 'L' else 'RGB'
+        if image.mode != pil_mode:
+            image = image.convert(pil_mode)
+        shape = (image.height, image.width) + ((len(pil_mode),) if len(pil_mode) > 1 else ())
+        return _store(np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(shape), mode, out)
+
+
+def decode(source: Source, mode: Optional[str] = None, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Decodes an image file, given by path, as encoded bytes or memoryview, or
+    as a binary file object, into a uint8 array.
+
+    Args:
+        source: The image to decode.
+        mode (str): `'rgb'`, `'bgr'` or `'gray'`; None keeps the image as
+            stored, 2-D for grayscale, RGB or RGBA otherwise (palette and
+            other modes are converted). Grayscale conversion uses the same
+            weights as `rgb_to_gray`, rounded.
+        out (np.ndarray): uint8 array of the decoded shape to decode into,
+            e.g. to reuse one buffer for many images of the same size.
+
+    Returns:
+        np.ndarray: `out` when given, otherwise a new array.
+    """
+    _check_mode(mode)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = memoryview(source).cast('B')
+        header = _netpbm(bytes(data[:_HEADER_SIZE]), mode)
+        if header is not None:
+            shape, offset = header
+            size = int(np.prod(shape))
+            if len(data) - offset >= size:
+                pixels = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset).reshape(shape)
+                return _store(pixels, mode, out)
+        return _decode_file(BytesIO(data), mode, out)
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return _decode_file(f, mode, out)
+    return _decode_file(source, mode, out)
+
+
+def _format(target, format):
+    if format is None:
+        extension = os.path.splitext(target)[1].lower() if isinstance(target, (str, os.PathLike)) else ''
+        if not extension:
+            return 'png'
+        format = next((name for name, extensions in FORMATS.items() if extension in extensions), None)
+        if format is None:
+            raise ValueError(f"No lossless format for {extension!r} files, expected one of {list(FORMATS)}")
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, expected one of {list(FORMATS)}")
+    return format
+
+
+def encode(image: np.ndarray, target: Optional[Target] = None, format: Optional[str] = None, compress_level: int = 6,
+           strategy: str = 'default', order: str = 'rgb') -> Union[bytes, Target]:
+    """
+    Encodes a uint8 image losslessly.
+
+    Args:
+        image (np.ndarray): 2-D grayscale or (h, w, c) image with 1, 3 or 4
+            channels.
+        target: Path or binary file to write to; the encoded bytes are
+            returned when None.
+        format (str): `'png'`, `'tiff'` (uncompressed), `'ppm'` (PGM for
+            grayscale images) or `'bmp'`, the latter two without alpha
+            channel. By default taken from the extension
+            of a path target, PNG otherwise.
+        compress_level (int): PNG zlib level, from 0 (stored, fastest) to 9
+            (smallest).
+        strategy (str): PNG zlib strategy, see `PNG_STRATEGIES`.
+        order (str): `'rgb'`, or `'bgr'` if the color channels of `image`
+            are in OpenCV order.
+
+    Returns:
+        The encoded bytes, or `target` once written.
+    """
+    from PIL import Image
+
+    format = _format(target, format)
+    if order not in ('rgb', 'bgr'):
+        raise ValueError(f"Unknown channel order {order!r}, expected 'rgb' or 'bgr'")
+    if image.dtype != np.uint8:
+        raise ValueError("Only uint8 images can be encoded")
+    if image.ndim == 3 and image.shape[2] == 1:
+        image = image[..., 0]
+    if order == 'bgr' and image.ndim == 3:
+        image = image[..., [2, 1, 0, 3][:image.shape[2]]]
+    if format in ('ppm', 'bmp') and image.ndim == 3 and image.shape[2] != 3:
+        raise ValueError(f"{format.upper()} only holds grayscale or RGB images")
+
+    options = {}
+    if format == 'png':
+        if strategy not in PNG_STRATEGIES:
+            raise ValueError(f"Unknown PNG strategy {strategy!r}, expected one of {list(PNG_STRATEGIES)}")
+        options = {'compress_level': compress_level, 'compress_type': PNG_STRATEGIES[strategy]}
+
+    output = BytesIO() if target is None else target
+    Image.fromarray(np.ascontiguousarray(image)).save(output, format=_PIL_FORMATS[format], **options)
+    return output.getvalue() if target is None else target
@@ -0,0 +1,231 @@
+"""Quality and detectability metrics of stego images.
+
+`compare` measures how far a stego image is from its cover (MSE, PSNR and
+SSIM) and how detectable its LSB changes are (the chi-square attack of
+Westfeld and Pfitzmann, computed on the stego image alone); `compare_many`
+does the same for a whole batch of pairs at once. Every `embed` also takes
+`metrics=True` to return them along with the stego image.
+"""
+import math
+from typing import Dict, Iterable, Tuple, Union
+
+import numpy as np
+
+from .utils import chunk_bounds, conv2d_batch
+
+
+__all__ = ["mse", "psnr", "ssim", "chi_square", "compare", "compare_many"]
+
+
+# SSIM settings of Wang et al. (2004): 11x11 Gaussian window of sigma 1.5
+_SSIM_SIGMA = 1.5
+_SSIM_RADIUS = 5
+_K1, _K2 = 0.01, 0.03
+
+# Elements processed at once, which bounds the temporaries
+_CHUNK = 1 << 22
+
+
+def _check(covers, stegos):
+    if covers.shape != stegos.shape:
+        raise ValueError(f"Cover and stego images differ in shape: {covers.shape[1:]} and {stegos.shape[1:]}")
+
+
+def _mse(covers, stegos):
+    """MSE of every pair of two `(n, ...)` stacks."""
+    _check(covers, stegos)
+    n = len(covers)
+    covers, stegos = covers.reshape(n, -1), stegos.reshape(n, -1)
+    total = np.zeros(n)
+    step = max(_CHUNK // max(n, 1), 1)
+    for start, stop in chunk_bounds(covers.shape[1], first=step, largest=step):
+        diff = np.subtract(stegos[:, start:stop], covers[:, start:stop], dtype=np.float64)
+        total += np.einsum('ij,ij->i', diff, diff)
+    return total / max(covers.shape[1], 1)
+
+
+def _psnr(mse, data_range):
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(data_range ** 2 / mse)
+
+
+def _ssim_window():
+    x = np.arange(-_SSIM_RADIUS, _SSIM_RADIUS + 1)
+    g = np.exp(-x ** 2 / (2 * _SSIM_SIGMA ** 2))
+    g /= g.sum()
+    # Rank-1, so conv2d applies it as two 1-D passes
+    return np.outer(g, g)
+
+
+def _ssim_planes(x, y, data_range):
+    """Mean SSIM of every plane of two `(p, h, w)` float64 stacks."""
+    window = _ssim_window()
+    c1, c2 = (_K1 * data_range) ** 2, (_K2 * data_range) ** 2
+    # Local means and second moments, filtered with the window as a whole
+    # rather than copied out window by window
+    mu_x = conv2d_batch(x, window)
+    mu_y = conv2d_batch(y, window)
+    tmp = np.empty_like(x)
+    s_xx = conv2d_batch(np.multiply(x, x, out=tmp), window)
+    s_yy = conv2d_batch(np.multiply(y, y, out=tmp), window)
+    s_xy = conv2d_batch(np.multiply(x, y, out=tmp), window)
+
+    # Variances and covariance, then the SSIM map, all in place
+    s_xx -= np.multiply(mu_x, mu_x, out=tmp)
+    s_yy -= np.multiply(mu_y, mu_y, out=tmp)
+    s_xy -= np.multiply(mu_x, mu_y, out=tmp)
+    # (2 mu_x mu_y + c1) (2 s_xy + c2)
+    tmp *= 2
+    tmp += c1
+    s_xy *= 2
+    s_xy += c2
+    s_xy *= tmp
+    # (mu_x^2 + mu_y^2 + c1) (s_xx + s_yy + c2)
+    np.multiply(mu_x, mu_x, out=mu_x)
+    mu_x += np.multiply(mu_y, mu_y, out=mu_y)
+    mu_x += c1
+    s_xx += s_yy
+    s_xx += c2
+    mu_x *= s_xx
+    s_xy /= mu_x
+
+    # Border pixels, whose window sticks out of the image, are left out
+    r = _SSIM_RADIUS
+    return s_xy[:, r:-r, r:-r].mean(axis=(1, 2))
+
+
+def _ssim(covers, stegos, data_range):
+    """Mean SSIM of every pair of two `(n, h, w)` or `(n, h, w, c)` stacks, averaged over channels."""
+    _check(covers, stegos)
+    n, h, w = covers.shape[:3]
+    if min(h, w) <= 2 * _SSIM_RADIUS:
+        return np.full(n, np.nan)
+    if covers.ndim == 4:
+        # Every channel is a plane of its own
+        covers = np.moveaxis(covers, 3, 1).reshape(-1, h, w)
+        stegos = np.moveaxis(stegos, 3, 1).reshape(-1, h, w)
+    step = max(_CHUNK // (h * w), 1)
+    planes = np.concatenate([_ssim_planes(covers[start:stop].astype(np.float64), stegos[start:stop].astype(np.float64),
+                                          data_range)
+                             for start, stop in chunk_bounds(len(covers), first=step, largest=step)])
+    return planes.reshape(n, -1).mean(axis=1)
+
+
+def _gamma_q(a, x):
+    """Regularized upper incomplete gamma function Q(a, x)."""
+    if x <= 0:
+        return 1.0
+    log_prefix = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        # Series of P(a, x)
+        term = total = 1.0 / a
+        k = a
+        while abs(term) > abs(total) * 1e-15:
+            k += 1
+            term *= x / k
+            total += term
+        return max(1.0 - total * math.exp(log_prefix), 0.0)
+    # Continued fraction of Q(a, x), modified Lentz's method
+    tiny = 1e-300
+    b = x + 1 - a
+    c, d = 1 / tiny, 1 / b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = 1 / (d if abs(d) > tiny else tiny)
+        c = b + an / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        if abs(d * c - 1) < 1e-15:
+            break
+    return math.exp(log_prefix) * h
+
+
+def _chi_square(stegos):
+    """Chi-square statistic and probability of embedding of every image of a `(n, ...)` uint8 stack."""
+    if stegos.dtype != np.uint8:
+        raise ValueError("The chi-square attack needs uint8 images")
+    n = len(stegos)
+    flat = stegos.reshape(n, -1)
+    offsets = 256 * np.arange(n, dtype=np.intp)[:, None]
+    hist = np.zeros(256 * n, dtype=np.int64)
+    step = max(_CHUNK // max(n, 1), 1)
+    for start, stop in chunk_bounds(flat.shape[1], first=step, largest=step):
+        hist += np.bincount((flat[:, start:stop] + offsets).ravel(), minlength=256 * n)
+    hist = hist.reshape(n, 128, 2)
+
+    # LSB embedding evens out the counts of the values 2k and 2k + 1
+    expected = hist.sum(axis=2) / 2
+    keep = expected > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(keep, (hist[..., 0] - expected) ** 2 / expected, 0)
+    statistic = terms.sum(axis=1)
+    dof = keep.sum(axis=1) - 1
+    p = np.array([_gamma_q(k / 2, s / 2) if k > 0 else np.nan for s, k in zip(statistic, dof)])
+    return statistic, p
+
+
+def mse(cover: np.ndarray, stego: np.ndarray) -> float:
+    """Mean squared error between a cover and its stego image."""
+    return float(_mse(cover[None], stego[None])[0])
+
+
+def psnr(cover: np.ndarray, stego: np.ndarray, data_range: float = 255) -> float:
+    """Peak signal-to-noise ratio in dB, infinite for identical images."""
+    return float(_psnr(_mse(cover[None], stego[None]), data_range)[0])
+
+
+def ssim(cover: np.ndarray, stego: np.ndarray, data_range: float = 255) -> float:
+    """
+    Mean structural similarity of a 2-D or `(h, w, c)` pair, averaged over
+    channels, with the 11x11 Gaussian window of Wang et al. Pixels closer
+    than 5 to the border are left out; NaN for images too small for a
+    window.
+    """
+    return float(_ssim(cover[None], stego[None], data_range)[0])
+
+
+def chi_square(stego: np.ndarray) -> Tuple[float, float]:
+    """
+    Chi-square attack of Westfeld and Pfitzmann on the histogram of a uint8
+    image. Returns the statistic and the probability that the pairs of
+    values (2k, 2k + 1) have been evened out by LSB embedding, which is
+    close to 1 when the whole image carries random LSBs.
+    """
+    statistic, p = _chi_square(stego[None])
+    return float(statistic[0]), float(p[0])
+
+
+def compare(cover: np.ndarray, stego: np.ndarray, data_range: float = 255) -> Dict[str, float]:
+    """
+    All metrics of a cover/stego pair of the same shape: `mse`, `psnr`,
+    `ssim`, and the `chi_square` statistic and its probability of embedding
+    `chi_square_p` on the stego image.
+    """
+    return {name: float(values[0]) for name, values in compare_many(cover[None], stego[None], data_range).items()}
+
+
+def compare_many(covers: Union[np.ndarray, Iterable[np.ndarray]], stegos: Union[np.ndarray, Iterable[np.ndarray]],
+                 data_range: float = 255) -> Dict[str, np.ndarray]:
+    """
+    Metrics of a batch of cover/stego pairs, as arrays with one value per
+    pair. Stacks of same-sized images, `(n, h, w)` or `(n, h, w, c)` arrays,
+    are processed all at once; images of different sizes can be given as
+    sequences instead and are then compared pair by pair.
+    """
+    if not (isinstance(covers, np.ndarray) and isinstance(stegos, np.ndarray)):
+        results = [compare(cover, stego, data_range) for cover, stego in zip(covers, stegos)]
+        names = ('mse', 'psnr', 'ssim', 'chi_square', 'chi_square_p')
+        return {name: np.array([result[name] for result in results], dtype=np.float64) for name in names}
+
+    errors = _mse(covers, stegos)
+    statistic, p = _chi_square(stegos)
+    return {
+        'mse': errors,
+        'psnr': _psnr(errors, data_range),
+        'ssim': _ssim(covers, stegos, data_range),
+        'chi_square': statistic,
+        'chi_square_p': p,
+    }
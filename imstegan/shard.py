@@ -0,0 +1,114 @@
+"""Splitting one payload across several carrier images.
+
+The payload is cut into one shard per carrier, sized in proportion to each
+carrier's capacity. Every shard starts with a small header holding its
+sequence number, the total number of shards and a checksum of the whole
+payload, so the stego images can be extracted in any order and the payload
+is verified after reassembly. Capacities, embedding and extraction all run
+on the worker pool of `imstegan.batch`.
+"""
+import struct
+import zlib
+from typing import Any, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+from .batch import capacity_many, embed_many, extract_many
+from .utils import BitStream, message_to_bytes, payload_bits
+
+
+__all__ = ["split_payload", "join_shards", "shard_capacities", "embed_sharded", "extract_sharded"]
+
+
+# Header of every shard: magic, sequence number, shard count and CRC-32 of the payload
+SHARD_MAGIC = b'SH'
+_SHARD_HEADER = struct.Struct('>2sIII')
+
+# Bits taken by the frame header every shard is embedded with
+_FRAME_BITS = len(payload_bits(b'', framed=True))
+
+
+def _check_framed(algorithm):
+    # Shard headers contain NUL bytes, which end delimiter-terminated messages
+    if not getattr(algorithm, 'framed', getattr(algorithm, '_framed', True)):
+        raise ValueError("Sharding needs an algorithm constructed with framed=True")
+
+
+def split_payload(payload: Union[str, bytes, memoryview, BitStream], capacities: Sequence[int]) -> List[bytes]:
+    """
+    Splits `payload` into one shard per carrier, `capacities` being the
+    number of payload bytes each carrier can hold (see `shard_capacities`).
+
+    Shard sizes are proportional to the capacities, so the work and the
+    distortion are spread evenly. Every shard, even an empty one, carries
+    its header, so every carrier must receive its shard.
+    """
+    payload = message_to_bytes(payload)
+    capacities = np.maximum(np.asarray(capacities, dtype=np.int64), 0)
+    total = int(capacities.sum())
+    if len(payload) > total:
+        raise ValueError(f"Payload is too large for the carriers: needs {len(payload)} bytes, "
+                         f"capacity is {total}")
+    # Shard i ends at floor(len * cumulative capacity / total), never above its own capacity
+    bounds = np.concatenate(([0], np.cumsum(capacities) * len(payload) // max(total, 1)))
+    checksum = zlib.crc32(payload)
+    count = len(capacities)
+    return [_SHARD_HEADER.pack(SHARD_MAGIC, i, count, checksum) + payload[start:stop]
+            for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def join_shards(shards: Iterable[bytes]) -> bytes:
+    """Reassembles shards produced by `split_payload`, given in any order."""
+    parts = {}
+    count = checksum = None
+    for shard in shards:
+        if len(shard) < _SHARD_HEADER.size:
+            raise ValueError("Not a payload shard")
+        magic, index, shard_count, shard_checksum = _SHARD_HEADER.unpack_from(shard)
+        if magic != SHARD_MAGIC:
+            raise ValueError("Not a payload shard")
+        if count is None:
+            count, checksum = shard_count, shard_checksum
+        elif (shard_count, shard_checksum) != (count, checksum):
+            raise ValueError("Shards belong to different payloads")
+        if index >= count or index in parts:
+            raise ValueError(f"Invalid or duplicate shard {index}")
+        parts[index] = shard[_SHARD_HEADER.size:]
+
+    if count is None:
+        return b''
+    if len(parts) != count:
+        missing = sorted(set(range(count)) - set(parts))
+        raise ValueError(f"Missing {len(missing)} of {count} shards, e.g. {missing[:10]}")
+    payload = b''.join(parts[i] for i in range(count))
+    if zlib.crc32(payload) != checksum:
+        raise ValueError("Reassembled payload does not match its checksum")
+    return payload
+
+
+def shard_capacities(algorithm: Any, images: Iterable[np.ndarray], workers: Optional[int] = None) -> List[int]:
+    """Number of payload bytes a shard embedded into each image can hold."""
+    return [max((bits - _FRAME_BITS) // 8 - _SHARD_HEADER.size, 0)
+            for bits in capacity_many(algorithm, images, workers)]
+
+
+def embed_sharded(algorithm: Any, images: Sequence[np.ndarray], payload: Union[str, bytes, memoryview, BitStream],
+                  workers: Optional[int] = None) -> List[np.ndarray]:
+    """
+    Splits `payload` across `images` and embeds the shards in parallel with
+    a pool of `workers` processes. `algorithm` must be constructed with
+    `framed=True`. Returns the stego images in input order.
+    """
+    _check_framed(algorithm)
+    shards = split_payload(payload, shard_capacities(algorithm, images, workers))
+    return list(embed_many(algorithm, images, shards, workers))
+
+
+def extract_sharded(algorithm: Any, images: Iterable[np.ndarray], workers: Optional[int] = None) -> bytes:
+    """
+    Extracts the shards of every image in parallel and reassembles the
+    payload, whatever the order of `images`. Returns the payload as bytes.
+    """
+    _check_framed(algorithm)
+    shards = (shard for _, shard in extract_many(algorithm, images, workers, ordered=False, as_bytes=True))
+    return join_shards(shards)
@@ -1,3 +1,22 @@
+import importlib
+
 from .general import *
-from .dct8 import *
-from .conv2d import *
\ No newline at end of file
+from .conv2d import *
+from .permutation import *
+from .bitstream import *
+from .profiling import *
+from .channels import *
+
+
+# dct8 pulls in numba, it is only imported when one of its functions is used
+_LAZY = {name: '.dct8' for name in ('dct8x8', 'idct8x8', 'blockview', 'dct8x8_blocks', 'idct8x8_blocks')}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        return getattr(importlib.import_module(_LAZY[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
\ No newline at end of file
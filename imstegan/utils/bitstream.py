@@ -0,0 +1,176 @@
+import struct
+
+import numpy as np
+
+from .general import DelimiterDecoder
+
+
+__all__ = ["BitStream", "FrameDecoder", "payload_bits", "payload_decoder", "message_to_bytes", "bytes_to_message"]
+
+
+# Header of framed payloads: magic, version and payload length in bytes
+FRAME_MAGIC = b'IS'
+FRAME_VERSION = 1
+_FRAME_HEADER = struct.Struct('>2sBI')
+
+
+class BitStream():
+    """Payload stored as a flat `np.uint8` array of 0/1 bits.
+
+    Bits are ordered most significant first within every byte. Slicing and
+    `groups` return views of the same buffer, so large binary payloads are
+    never copied into '0'/'1' strings.
+
+    Args:
+        data: `bytes`, `bytearray`, `memoryview`, `str` (encoded as UTF-8)
+            or another `BitStream`.
+    """
+    def __init__(self, data=b''):
+        if isinstance(data, BitStream):
+            self.bits = data.bits
+            return
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError(f"Cannot build a BitStream from {type(data).__name__}")
+        self.bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+    @classmethod
+    def from_bits(cls, bits):
+        """Wraps an existing array of 0/1 values without copying it."""
+        stream = cls()
+        stream.bits = np.asarray(bits, dtype=np.uint8).reshape(-1)
+        return stream
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return int(self.bits[index])
+        return BitStream.from_bits(self.bits[index])
+
+    def __add__(self, other):
+        return BitStream.from_bits(np.concatenate((self.bits, BitStream(other).bits)))
+
+    def __repr__(self):
+        return f"BitStream({len(self)} bits)"
+
+    def groups(self, k):
+        """
+        Bits as a `(n, k)` array of k-bit groups. This is a view when the
+        length is a multiple of `k`; otherwise the last group is zero-padded.
+        """
+        bits = self.bits
+        if len(bits) % k:
+            bits = np.concatenate((bits, np.zeros(k - len(bits) % k, dtype=np.uint8)))
+        return bits.reshape(-1, k)
+
+    def tobytes(self):
+        return np.packbits(self.bits).tobytes()
+
+    def decode(self):
+        return bytes_to_message(self.tobytes())
+
+
+class FrameDecoder():
+    """
+    Incremental decoder for framed bit streams, the counterpart of
+    `payload_bits(..., framed=True)`.
+
+    The header is decoded as soon as its bits have been fed; after that the
+    exact output buffer is allocated and only the payload bits are consumed.
+    `needed` tells the caller how much is left to read, so extractors can
+    stop right at the end of the payload. `capacity`, the number of bits
+    the carrier can hold at most, header included, rejects headers that
+    claim more before anything is allocated for them.
+    """
+    def __init__(self, capacity=None):
+        self._capacity = capacity
+        self._header = np.empty(0, dtype=np.uint8)
+        self._bits = None
+        self._filled = 0
+
+    @property
+    def done(self):
+        return self._bits is not None and self._filled == len(self._bits)
+
+    def needed(self, bits_per_unit=1):
+        """Number of units of `bits_per_unit` bits still to be read."""
+        if self._bits is None:
+            remaining = _FRAME_HEADER.size * 8 - len(self._header)
+        else:
+            remaining = len(self._bits) - self._filled
+        return -(-remaining // bits_per_unit)
+
+    def feed(self, bits):
+        if self.done:
+            return True
+        if self._bits is None:
+            take = _FRAME_HEADER.size * 8 - len(self._header)
+            self._header = np.concatenate((self._header, bits[:take]))
+            bits = bits[take:]
+            if len(self._header) < _FRAME_HEADER.size * 8:
+                return False
+            magic, version, length = _FRAME_HEADER.unpack(np.packbits(self._header).tobytes())
+            if magic != FRAME_MAGIC:
+                raise ValueError("No framed payload found in image")
+            if version != FRAME_VERSION:
+                raise ValueError(f"Unsupported payload frame version: {version}")
+            if self._capacity is not None and len(self._header) + length * 8 > self._capacity:
+                raise ValueError("Framed payload is truncated, image holds less data than its header claims")
+            self._bits = np.empty(length * 8, dtype=np.uint8)
+        take = min(len(bits), len(self._bits) - self._filled)
+        self._bits[self._filled:self._filled + take] = bits[:take]
+        self._filled += take
+        return self.done
+
+    def message(self):
+        if not self.done:
+            raise ValueError("Framed payload is truncated, image holds less data than its header claims")
+        return np.packbits(self._bits).tobytes()
+
+
+def payload_bits(message, delimiter=b'\0', framed=False):
+    """
+    Bits to embed for `message`, as a flat 0/1 array: the message followed by
+    `delimiter`, or a header with magic, version and length followed by the
+    message when `framed`. Either way the message is zero-padded to whole
+    bytes, which is how it is decoded.
+    """
+    stream = BitStream(message)
+    length = -(-len(stream) // 8)
+    padding = np.zeros(length * 8 - len(stream), dtype=np.uint8)
+    if not framed:
+        # The delimiter is only looked for on byte boundaries
+        return np.concatenate((stream.bits, padding, BitStream(delimiter).bits))
+    header = BitStream(_FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, length))
+    return np.concatenate((header.bits, stream.bits, padding))
+
+
+def payload_decoder(delimiter=b'\0', framed=False, capacity=None):
+    """
+    Decoder matching `payload_bits` with the same arguments. `capacity` is
+    an upper bound of the bits the carrier holds, see `FrameDecoder`.
+    """
+    return FrameDecoder(capacity) if framed else DelimiterDecoder(delimiter)
+
+
+def message_to_bytes(message):
+    """Bytes of a message: text is encoded as UTF-8, bit streams are packed."""
+    if isinstance(message, str):
+        return message.encode('utf-8')
+    if isinstance(message, BitStream):
+        return message.tobytes()
+    return bytes(message)
+
+
+def bytes_to_message(data):
+    """
+    Decodes extracted bytes as UTF-8, falling back to Latin-1 for messages
+    embedded by versions that wrote one byte per character.
+    """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
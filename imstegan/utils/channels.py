@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from .bitstream import message_to_bytes, payload_bits
+from .general import output_buffer
+
+
+__all__ = ["is_multichannel", "split_channels", "join_channels", "map_channels", "embed_channels", "extract_channels",
+           "channels_capacity"]
+
+
+def split_channels(message, channels):
+    """Interleaves the bytes of `message` across `channels` parts, byte `i` going to part `i % channels`."""
+    data = message_to_bytes(message)
+    return [data[k::channels] for k in range(channels)]
+
+
+def join_channels(parts):
+    """Inverse of `split_channels`."""
+    channels = len(parts)
+    total = sum(len(part) for part in parts)
+    data = bytearray(total)
+    for k, part in enumerate(parts):
+        if len(part) != len(range(k, total, channels)):
+            raise ValueError("Channel payloads do not fit together, image was not embedded in multichannel mode")
+        data[k::channels] = part
+    return bytes(data)
+
+
+def map_channels(fn, channels, workers=None):
+    """
+    Calls `fn(k)` for every channel `k` in a pool of threads and returns the
+    results in channel order. NumPy and numba release the GIL in their
+    kernels, so the planes are processed concurrently.
+    """
+    workers = workers or channels
+    if workers == 1:
+        return [fn(k) for k in range(channels)]
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(fn, range(channels)))
+
+
+def embed_channels(algorithm, image, message, out=None, inplace=False, workers=None, metrics=False):
+    """
+    Embeds `message` into a multichannel image, every plane being a separate
+    carrier for `algorithm` that holds the bytes of its channel, see
+    `split_channels`. Planes are written in place into the output buffer,
+    which is returned, along with the metrics of `imstegan.metrics.compare`
+    when `metrics` is True. When the buffer is `out` or `image` itself,
+    every plane is checked to fit before any is written.
+    """
+    parts = split_channels(message, image.shape[2])
+    if inplace or out is not None:
+        # Planes would be written until the first one too small, check them
+        # all beforehand so that the caller's array is left as is
+        framed = getattr(algorithm, '_framed', False)
+        capacities = map_channels(lambda k: algorithm.capacity(image[..., k]), image.shape[2], workers)
+        for k, (part, capacity) in enumerate(zip(parts, capacities)):
+            needed = len(payload_bits(part, framed=framed))
+            if needed > capacity:
+                raise ValueError(f"Message is too large for the image: plane {k} needs {needed} bits, "
+                                 f"capacity is {capacity}")
+    buffer = output_buffer(image, out, inplace)
+    cover = buffer.copy() if metrics else None
+    map_channels(lambda k: algorithm.embed(buffer[..., k], parts[k], inplace=True), buffer.shape[2], workers)
+    if cover is None:
+        return buffer
+    # imstegan.metrics depends on this package
+    from ..metrics import compare
+    return buffer, compare(cover, buffer)
+
+
+def extract_channels(algorithm, image, workers=None):
+    """Extracts and joins the bytes embedded by `embed_channels`."""
+    parts = map_channels(lambda k: algorithm.extract(image[..., k], as_bytes=True), image.shape[2], workers)
+    return join_channels(parts)
+
+
+def channels_capacity(capacities, framed=False):
+    """
+    Capacity in bits of a multichannel carrier from the capacities of its
+    planes, reported like the one of a single plane: the largest payload
+    that fits, plus the overhead of one delimiter or header.
+    """
+    overhead = len(payload_bits(b'', framed=framed))
+    channels = len(capacities)
+    # Plane k holds bytes k, k + channels, ..., so n bytes fit when plane k
+    # holds ceil((n - k) / channels) bytes for every k
+    longest = min(channels * ((capacity - overhead) // 8) + k for k, capacity in enumerate(capacities))
+    return max(8 * longest + overhead, 0)
+
+
+def is_multichannel(image):
+    """Whether `image` has several color planes."""
+    return image.ndim == 3 and image.shape[2] > 1
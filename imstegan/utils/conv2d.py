@@ -1,15 +1,163 @@
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 
+
+__all__ = ["conv2d", "conv2d_batch", "separate_kernel", "gradient_magnitude"]
+
+
+# Pixels per band of `gradient_magnitude`, which bounds its temporaries
+_BAND_PIXELS = 1 << 20
+
+
 def _conv2d(input, kernel):
     s = kernel.shape + tuple(np.subtract(input.shape, kernel.shape) + 1)
     windows = as_strided(input, shape = s, strides = input.strides * 2)
     return np.einsum('ij,ijkl->kl', kernel, windows)
 
 
-def conv2d(img, kernel):
+def separate_kernel(kernel):
+    """
+    Splits a rank-1 `kernel` into the column and row vectors whose outer
+    product it is, or returns None if it is not separable. Integer kernels
+    such as Sobel are split into integer vectors.
+    """
+    kernel = np.asarray(kernel)
+    i, j = np.unravel_index(np.argmax(np.abs(kernel)), kernel.shape)
+    if kernel[i, j] == 0:
+        return None
+    row = kernel[i]
+    if np.issubdtype(kernel.dtype, np.integer):
+        row = row // np.gcd.reduce(row)
+        col = kernel[:, j] // row[j] if np.all(kernel[:, j] % row[j] == 0) else kernel[:, j] / row[j]
+        separable = np.array_equal(np.outer(col, row), kernel)
+    else:
+        col = kernel[:, j] / row[j]
+        separable = np.allclose(np.outer(col, row), kernel, rtol=1e-12, atol=0)
+    return (col, row) if separable else None
+
+
+def _axpy(dst, src, weight, scratch):
+    """`dst += weight * src` without temporaries."""
+    if weight == 1:
+        np.add(dst, src, out=dst)
+    elif weight == -1:
+        np.subtract(dst, src, out=dst)
+    else:
+        np.multiply(src, weight, out=scratch)
+        np.add(dst, scratch, out=dst)
+
+
+def _correlate1d(src, weights, axis, dst, scratch):
+    """Zero padded correlation of `src` with odd-sized `weights` along the last or second to last axis."""
+    n = src.shape[axis]
+    pad = len(weights) // 2
+    dst[...] = 0
+    for t, weight in enumerate(weights):
+        shift = t - pad
+        if weight == 0 or abs(shift) >= n:
+            continue
+        # dst[x] += weight * src[x + shift] wherever x + shift is inside
+        d = slice(max(-shift, 0), n - max(shift, 0))
+        s = slice(max(shift, 0), n + min(shift, 0))
+        index_d = (Ellipsis, d) if axis == -1 else (Ellipsis, d, slice(None))
+        index_s = (Ellipsis, s) if axis == -1 else (Ellipsis, s, slice(None))
+        _axpy(dst[index_d], src[index_s], weight, scratch[index_d])
+    return dst
+
+
+def _buffer(work, name, shape, dtype):
+    """Scratch array `name` of `work`, reallocated when the shape or dtype changes."""
+    if name not in work or work[name].shape != shape or work[name].dtype != dtype:
+        work[name] = np.empty(shape, dtype=dtype)
+    return work[name]
+
+
+def _correlate(images, kernel, dtype, out, separable, work=None):
+    """`conv2d` over the last two axes of `images`; `work` holds scratch buffers reused across calls."""
+    dtype = np.dtype(dtype if dtype is not None else np.result_type(images.dtype, kernel.dtype))
+    if out is None:
+        out = np.empty(images.shape, dtype=dtype)
+    elif out.shape != images.shape:
+        raise ValueError(f"out must be an array of shape {images.shape}")
+    factors = separate_kernel(kernel) if separable else None
+
+    if factors is None:
+        # Dense kernel, weighted sum over a strided window view of each padded image
+        pad_h, pad_w = (kernel.shape[0] - 1) // 2, (kernel.shape[1] - 1) // 2
+        kernel = kernel.astype(dtype, copy=False)
+        for index in np.ndindex(images.shape[:-2]):
+            img = np.pad(images[index].astype(dtype, copy=False), pad_width=((pad_h, pad_h), (pad_w, pad_w)),
+                         mode='constant')
+            out[index] = _conv2d(img, kernel)
+        return out
+
+    # Rank-1 kernel: a pass along the rows then one along the columns
+    work = {} if work is None else work
+    rows = _buffer(work, 'rows', images.shape, dtype)
+    scratch = _buffer(work, 'scratch', images.shape, dtype)
+    col, row = factors
+    _correlate1d(images, row, -1, rows, scratch)
+    return _correlate1d(rows, col, -2, out, scratch)
+
+
+def conv2d(img, kernel, dtype=None, out=None, separable=True):
+    """
+    Correlates a 2-D image with an odd-sized kernel, zero padded so that
+    the output has the shape of `img`.
+
+    Rank-1 kernels, such as Sobel or box filters, are applied as one pass
+    along the rows and one along the columns, which is faster and only
+    needs two image-sized buffers; other kernels go through a strided window
+    view of the padded image.
+
+    Args:
+        img (np.ndarray): 2-D image.
+        kernel (np.ndarray): 2-D kernel with odd sides.
+        dtype: Dtype of the computation and of the result, by default that
+            of `img` and `kernel` combined. `np.float32` halves the memory.
+        out (np.ndarray): Array of the shape of `img` to write the result to.
+        separable (bool): Split rank-1 kernels.
+    """
     assert img.ndim == 2 and kernel.size % 2 == 1
-    # Force padding to keep shape
-    pad = (kernel.shape[0] - 1) // 2
-    img = np.pad(img, pad_width=((pad, pad), (pad, pad)), mode='constant')
-    return _conv2d(img, kernel)
\ No newline at end of file
+    return _correlate(img, np.asarray(kernel), dtype, out, separable)
+
+
+def conv2d_batch(images, kernel, dtype=None, out=None, separable=True):
+    """`conv2d` of every image of a `(n, h, w)` stack, vectorized over the stack for rank-1 kernels."""
+    assert images.ndim == 3 and kernel.size % 2 == 1
+    return _correlate(images, np.asarray(kernel), dtype, out, separable)
+
+
+def gradient_magnitude(img, kernel, dtype=np.float64, out=None):
+    """
+    `sqrt(Gx**2 + Gy**2)`, Gx and Gy being `img` correlated with `kernel`
+    and with its transpose, e.g. the Sobel edge magnitude. `img` can be a
+    single image or a `(n, h, w)` stack.
+
+    Rows are processed in bands of about a megapixel, each read with the
+    rows around it that the kernel needs, and the squares and sum are
+    computed in place, so besides the output only a few band-sized buffers
+    are allocated. The result is the same as on the whole image at once.
+    """
+    assert img.ndim in (2, 3) and kernel.size % 2 == 1
+    kernel = np.asarray(kernel)
+    if out is None:
+        out = np.empty(img.shape, dtype=dtype)
+    elif out.shape != img.shape:
+        raise ValueError(f"out must be an array of shape {img.shape}")
+
+    height = img.shape[-2]
+    halo = max(kernel.shape) // 2
+    band_rows = max(_BAND_PIXELS // max(img[..., 0, :].size, 1), 1)
+    work = {}
+    for start in range(0, height, band_rows):
+        stop = min(start + band_rows, height)
+        lo, hi = max(start - halo, 0), min(stop + halo, height)
+        band = img[..., lo:hi, :]
+        gx = _correlate(band, kernel, dtype, _buffer(work, 'gx', band.shape, dtype), True, work)
+        gy = _correlate(band, kernel.T, dtype, _buffer(work, 'gy', band.shape, dtype), True, work)
+        np.multiply(gx, gx, out=gx)
+        np.multiply(gy, gy, out=gy)
+        np.add(gx, gy, out=gx)
+        np.sqrt(gx[..., start - lo:stop - lo, :], out=out[..., start:stop, :])
+    return out
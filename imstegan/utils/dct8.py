@@ -27,122 +27,186 @@
 # I wrote this in a hurry, so it's probably not the prettiest code and I suspect
 # the way I calculate 2-D DCT is not the most efficient.
 
+import threading
+
 import numba
 import numpy as np
 
 
-@numba.njit()
-def dct8x8(block):
+# The 1-D transforms write into a preallocated output, so that the single
+# block and batched transforms below share them and give the same results.
+
+@numba.njit(cache=True)
+def _dct8(vector, out):
 	# DCT type II, scaled. Algorithm by Arai, Agui, Nakajima, 1988.
-	# See: https://web.stanford.edu/class/ee398a/handouts/lectures/07-TransformCoding.pdf#page=30	
-	def dct8(vector):
-		v0 = vector[0] + vector[7]
-		v1 = vector[1] + vector[6]
-		v2 = vector[2] + vector[5]
-		v3 = vector[3] + vector[4]
-		v4 = vector[3] - vector[4]
-		v5 = vector[2] - vector[5]
-		v6 = vector[1] - vector[6]
-		v7 = vector[0] - vector[7]
-		
-		v8 = v0 + v3
-		v9 = v1 + v2
-		v10 = v1 - v2
-		v11 = v0 - v3
-		v12 = -v4 - v5
-		v13 = (v5 + v6) * 0.7071067811865476
-		v14 = v6 + v7
-		
-		v15 = v8 + v9
-		v16 = v8 - v9
-		v17 = (v10 + v11) * 0.7071067811865476
-		v18 = (v12 + v14) * 0.38268343236508984
-		
-		v19 = -v12 * 0.5411961001461969 - v18
-		v20 = v14 * 1.3065629648763766 - v18
-		
-		v21 = v17 + v11
-		v22 = v11 - v17
-		v23 = v13 + v7
-		v24 = v7 - v13
-		
-		v25 = v19 + v24
-		v26 = v23 + v20
-		v27 = v23 - v20
-		v28 = v24 - v19
-		
-		return np.array([
-			0.35355339059327373 * v15,
-			0.25489778955207960 * v26,
-			0.27059805007309850 * v21,
-			0.30067244346752264 * v28,
-			0.35355339059327373 * v16,
-			0.44998811156820780 * v25,
-			0.65328148243818820 * v22,
-			1.28145772387075270 * v27,
-		])
+	# See: https://web.stanford.edu/class/ee398a/handouts/lectures/07-TransformCoding.pdf#page=30
+	v0 = vector[0] + vector[7]
+	v1 = vector[1] + vector[6]
+	v2 = vector[2] + vector[5]
+	v3 = vector[3] + vector[4]
+	v4 = vector[3] - vector[4]
+	v5 = vector[2] - vector[5]
+	v6 = vector[1] - vector[6]
+	v7 = vector[0] - vector[7]
+	
+	v8 = v0 + v3
+	v9 = v1 + v2
+	v10 = v1 - v2
+	v11 = v0 - v3
+	v12 = -v4 - v5
+	v13 = (v5 + v6) * 0.7071067811865476
+	v14 = v6 + v7
+	
+	v15 = v8 + v9
+	v16 = v8 - v9
+	v17 = (v10 + v11) * 0.7071067811865476
+	v18 = (v12 + v14) * 0.38268343236508984
+	
+	v19 = -v12 * 0.5411961001461969 - v18
+	v20 = v14 * 1.3065629648763766 - v18
+	
+	v21 = v17 + v11
+	v22 = v11 - v17
+	v23 = v13 + v7
+	v24 = v7 - v13
+	
+	v25 = v19 + v24
+	v26 = v23 + v20
+	v27 = v23 - v20
+	v28 = v24 - v19
+	
+	out[0] = 0.35355339059327373 * v15
+	out[1] = 0.25489778955207960 * v26
+	out[2] = 0.27059805007309850 * v21
+	out[3] = 0.30067244346752264 * v28
+	out[4] = 0.35355339059327373 * v16
+	out[5] = 0.44998811156820780 * v25
+	out[6] = 0.65328148243818820 * v22
+	out[7] = 1.28145772387075270 * v27
 
-	ans = np.zeros((8, 8))
+
+@numba.njit(cache=True)
+def _idct8(vector, out):
+	# DCT type III, scaled. A straightforward inverse of the forward algorithm.
+	v15 = vector[0] / 0.35355339059327373
+	v26 = vector[1] / 0.25489778955207960
+	v21 = vector[2] / 0.27059805007309850
+	v28 = vector[3] / 0.30067244346752264
+	v16 = vector[4] / 0.35355339059327373
+	v25 = vector[5] / 0.44998811156820780
+	v22 = vector[6] / 0.65328148243818820
+	v27 = vector[7] / 1.28145772387075270
+	
+	v19 = (v25 - v28) / 2
+	v20 = (v26 - v27) / 2
+	v23 = (v26 + v27) / 2
+	v24 = (v25 + v28) / 2
+	
+	v7  = (v23 + v24) / 2
+	v11 = (v21 + v22) / 2
+	v13 = (v23 - v24) / 2
+	v17 = (v21 - v22) / 2
+	
+	v8 = (v15 + v16) / 2
+	v9 = (v15 - v16) / 2
+	
+	v18 = (v19 - v20) * 0.38268343236508984  # Different from original
+	v12 = -(v19 * 1.3065629648763766 - v18)
+	v14 = -(v18 - v20 * 0.5411961001461969)
+	
+	v6 = v14 - v7
+	v5 = v13 / 0.7071067811865476 - v6
+	v4 = -v5 - v12
+	v10 = v17 / 0.7071067811865476 - v11
+	
+	v0 = (v8 + v11) / 2
+	v1 = (v9 + v10) / 2
+	v2 = (v9 - v10) / 2
+	v3 = (v8 - v11) / 2
+	
+	out[0] = (v0 + v7) / 2
+	out[1] = (v1 + v6) / 2
+	out[2] = (v2 + v5) / 2
+	out[3] = (v3 + v4) / 2
+	out[4] = (v3 - v4) / 2
+	out[5] = (v2 - v5) / 2
+	out[6] = (v1 - v6) / 2
+	out[7] = (v0 - v7) / 2
+
+
+@numba.njit(cache=True)
+def _dct8x8(block, ans, inverse):
+	# Columns first, then rows, the latter copied as they are transformed in place
+	row = np.empty(8)
 	for idx in range(8):
-		ans[:, idx] = dct8(block[:, idx])
+		if inverse:
+			_idct8(block[:, idx], ans[:, idx])
+		else:
+			_dct8(block[:, idx], ans[:, idx])
 	for idx in range(8):
-		ans[idx, :] = dct8(ans[idx, :])
+		row[:] = ans[idx, :]
+		if inverse:
+			_idct8(row, ans[idx, :])
+		else:
+			_dct8(row, ans[idx, :])
+
+
+@numba.njit(cache=True)
+def dct8x8(block):
+	ans = np.zeros((8, 8))
+	_dct8x8(block, ans, False)
 	return ans
 
 
 def idct8x8(block):
-	# DCT type III, scaled. A straightforward inverse of the forward algorithm.
-	def idct8(vector):
-		v15 = vector[0] / 0.35355339059327373
-		v26 = vector[1] / 0.25489778955207960
-		v21 = vector[2] / 0.27059805007309850
-		v28 = vector[3] / 0.30067244346752264
-		v16 = vector[4] / 0.35355339059327373
-		v25 = vector[5] / 0.44998811156820780
-		v22 = vector[6] / 0.65328148243818820
-		v27 = vector[7] / 1.28145772387075270
-		
-		v19 = (v25 - v28) / 2
-		v20 = (v26 - v27) / 2
-		v23 = (v26 + v27) / 2
-		v24 = (v25 + v28) / 2
-		
-		v7  = (v23 + v24) / 2
-		v11 = (v21 + v22) / 2
-		v13 = (v23 - v24) / 2
-		v17 = (v21 - v22) / 2
-		
-		v8 = (v15 + v16) / 2
-		v9 = (v15 - v16) / 2
-		
-		v18 = (v19 - v20) * 0.38268343236508984  # Different from original
-		v12 = -(v19 * 1.3065629648763766 - v18)
-		v14 = -(v18 - v20 * 0.5411961001461969)
-		
-		v6 = v14 - v7
-		v5 = v13 / 0.7071067811865476 - v6
-		v4 = -v5 - v12
-		v10 = v17 / 0.7071067811865476 - v11
-		
-		v0 = (v8 + v11) / 2
-		v1 = (v9 + v10) / 2
-		v2 = (v9 - v10) / 2
-		v3 = (v8 - v11) / 2
-		
-		return np.array([
-			(v0 + v7) / 2,
-			(v1 + v6) / 2,
-			(v2 + v5) / 2,
-			(v3 + v4) / 2,
-			(v3 - v4) / 2,
-			(v2 - v5) / 2,
-			(v1 - v6) / 2,
-			(v0 - v7) / 2,
-		])
-
 	ans = np.zeros((8, 8))
-	for idx in range(8):
-		ans[:, idx] = idct8(block[:, idx])
-	for idx in range(8):
-		ans[idx, :] = idct8(ans[idx, :])
-	return ans
\ No newline at end of file
+	_dct8x8(np.asarray(block, dtype=np.float64), ans, True)
+	return ans
+
+# Batched transforms over all 8x8 blocks of an image
+
+def blockview(image):
+	"""Zero-copy (H/8, W/8, 8, 8) view of the complete 8x8 blocks of a 2-D image."""
+	h, w = image.shape[0] // 8, image.shape[1] // 8
+	return image[:h * 8, :w * 8].reshape(h, 8, w, 8).swapaxes(1, 2)
+
+
+@numba.njit(parallel=True, cache=True)
+def _dct8x8_blocks(blocks, out, inverse):
+	rows, cols = blocks.shape[0], blocks.shape[1]
+	for b in numba.prange(rows * cols):
+		_dct8x8(blocks[b // cols, b % cols], out[b // cols, b % cols], inverse)
+
+
+@numba.njit(cache=True)
+def _dct8x8_blocks_serial(blocks, out, inverse):
+	for i in range(blocks.shape[0]):
+		for j in range(blocks.shape[1]):
+			_dct8x8(blocks[i, j], out[i, j], inverse)
+
+
+# A parallel kernel launched from a thread other than the main one, e.g. by
+# multichannel mode or an asyncio executor, keeps the TBB threading layer of
+# numba from shutting down and the interpreter then hangs at exit. Such
+# threads run the serial kernel, they usually are parallel already.
+def _transform(blocks, out, inverse):
+	if threading.current_thread() is threading.main_thread():
+		_dct8x8_blocks(blocks, out, inverse)
+	else:
+		_dct8x8_blocks_serial(blocks, out, inverse)
+
+
+def dct8x8_blocks(blocks, out=None):
+	"""DCT of every block of a (H/8, W/8, 8, 8) array, e.g. from `blockview`."""
+	if out is None:
+		out = np.empty(blocks.shape)
+	_transform(blocks, out, False)
+	return out
+
+
+def idct8x8_blocks(blocks, out=None):
+	"""Inverse DCT of every block of a (H/8, W/8, 8, 8) array."""
+	if out is None:
+		out = np.empty(blocks.shape)
+	_transform(blocks, out, True)
+	return out
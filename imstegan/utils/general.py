@@ -1,3 +1,5 @@
+import warnings
+
 import numpy as np
 
 def message_to_binary(message):
@@ -16,3 +18,187 @@ def binary_to_message(binary_message):
 def rgb_to_gray(image):
     coef = np.array([0.299, 0.587, 0.114])[:, None]
     return (image@coef).squeeze()
+
+def open_carrier(path, shape, dtype=np.uint8, offset=0, mode='r+'):
+    """
+    Memory-maps a raw image file (e.g. the pixel data of an uncompressed scan)
+    as an array of `shape`, for use with the `embed_tiled`/`extract_tiled`
+    methods. Pixels are only paged in as they are processed.
+    """
+    return np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=tuple(shape))
+
+def output_buffer(image, out=None, inplace=False, grayscale=False):
+    """
+    Returns the uint8 array an `embed` writes into, holding the pixels of
+    `image`: `image` itself when `inplace`, `out` when given, otherwise a
+    new array. With `grayscale`, RGB images are converted to grayscale first
+    and single channel `(h, w, 1)` images are handled as `(h, w)`.
+    """
+    if inplace and out is not None:
+        raise ValueError("Pass either out or inplace=True, not both")
+    if grayscale and image.ndim == 3:
+        if image.shape[2] == 1:
+            image = image[..., 0]
+        elif image.shape[2] == 3:
+            if inplace:
+                raise ValueError("Cannot embed in place into an RGB image, it is converted to grayscale")
+            warnings.warn("Image is RGB, converting to grayscale")
+            image = rgb_to_gray(image)
+    if inplace:
+        if image.dtype != np.uint8:
+            raise ValueError("In-place embedding needs a uint8 image")
+        return image
+    if out is None:
+        return image.astype(np.uint8)
+    if out.dtype != np.uint8 or out.shape != image.shape:
+        raise ValueError(f"out must be a uint8 array of shape {image.shape}")
+    np.copyto(out, image, casting='unsafe')
+    return out
+
+def values_to_bits(values, n_bits):
+    """
+    Unpacks the `n_bits` lowest bits of every value into a flat 0/1 array,
+    most significant bit first. `n_bits` is either a single width or one
+    width per value.
+    """
+    values = np.asarray(values)
+    if np.ndim(n_bits) == 0:
+        if n_bits == 8 and values.dtype == np.uint8:
+            return np.unpackbits(values)
+        shifts = np.arange(n_bits - 1, -1, -1)
+        return ((values[:, None] >> shifts) & 1).astype(np.uint8).ravel()
+    n_bits = np.asarray(n_bits, dtype=np.int64)
+    group = np.repeat(np.arange(len(values)), n_bits)
+    shifts = np.cumsum(n_bits)[group] - 1 - np.arange(len(group))
+    return ((values[group] >> shifts) & 1).astype(np.uint8)
+
+def bits_to_values(bits, n_bits):
+    """
+    Packs consecutive groups of `n_bits` bits into integers, most significant
+    bit first; the inverse of `values_to_bits`. `n_bits` is either a single
+    width or one width per group. A last group cut short by the end of `bits`
+    is padded with zeros.
+    """
+    bits = np.asarray(bits)
+    if np.ndim(n_bits) == 0:
+        n_bits = np.full(-(-len(bits) // n_bits), n_bits, dtype=np.int64)
+    n_bits = np.asarray(n_bits, dtype=np.int64)
+    starts = np.cumsum(n_bits) - n_bits
+    values = np.zeros(len(n_bits), dtype=np.int64)
+    for t in range(int(n_bits.max()) if len(n_bits) else 0):
+        take = n_bits > t
+        pos = starts[take] + t
+        values[take] = values[take] << 1 | np.where(pos < len(bits), bits[np.minimum(pos, len(bits) - 1)], 0)
+    return values
+
+def find_sequence(data, sequence, start=0):
+    """
+    Returns the index of the first occurrence of `sequence` in the 1-D array
+    `data` at or after `start`, or -1 if there is none. Like `str.find`, an
+    empty `sequence` is found at `start`.
+    """
+    if not len(sequence):
+        return start if start <= len(data) else -1
+    stop = len(data) - len(sequence) + 1
+    if stop <= start:
+        return -1
+    hits = data[start:stop] == sequence[0]
+    for k in range(1, len(sequence)):
+        hits &= data[start + k:stop + k] == sequence[k]
+    idx = np.flatnonzero(hits)
+    return start + int(idx[0]) if len(idx) else -1
+
+def chunk_bounds(total, first=4096, largest=1 << 20, limit=None):
+    """
+    Yields `(start, stop)` ranges covering `[0, total)` with geometrically
+    growing sizes, so short messages only pay for a small first chunk.
+    `limit`, if given, is called before every chunk and returns how many
+    units are still needed (or `None` when unknown), which caps its size.
+    """
+    start, size = 0, first
+    while start < total:
+        stop = min(start + size, total)
+        need = limit() if limit is not None else None
+        if need is not None:
+            stop = min(stop, start + max(need, 1))
+        yield start, stop
+        start, size = stop, min(size * 2, largest)
+
+# Pixels per band of the row by row embedders, which bounds their temporaries
+_BAND_PIXELS = 1 << 16
+
+def row_bands(rows, width, first=16):
+    """
+    `chunk_bounds` over `rows` rows of `width` pixels, from `first` rows up
+    to bands of about 64K pixels: short messages only go through the top
+    of the image, and temporaries stay proportional to a band.
+    """
+    largest = max(_BAND_PIXELS // max(width, 1), 1)
+    return chunk_bounds(rows, first=min(first, largest), largest=largest)
+
+def check_capacity(band_capacity, bands, needed):
+    """
+    Raises `ValueError` unless `needed` bits fit into the `(start, stop)`
+    `bands`, `band_capacity(start, stop)` giving the bits each holds. Stops
+    at the band where the message ends, so that embedders can fail before
+    writing anything at little cost.
+    """
+    capacity = 0
+    for start, stop in bands:
+        if capacity >= needed:
+            return
+        capacity += band_capacity(start, stop)
+    if capacity < needed:
+        raise ValueError(f"Message is too large for the image: needs {needed} bits, capacity is {capacity}")
+
+
+class DelimiterDecoder():
+    """
+    Incremental decoder for delimiter-terminated bit streams.
+
+    Bits are fed in chunks with `feed`, packed into bytes and searched for the
+    delimiter; `feed` returns `True` once it has been found. `message` returns
+    the bytes before the delimiter, or everything read (including a trailing
+    partial byte) if the delimiter never showed up.
+    """
+    def __init__(self, delimiter=b'\0'):
+        self._delim = np.frombuffer(delimiter, dtype=np.uint8)
+        self._chunks = []
+        self._size = 0
+        self._end = None
+        self._tail = np.empty(0, dtype=np.uint8)
+        self._carry = np.empty(0, dtype=np.uint8)
+
+    @property
+    def done(self):
+        return self._end is not None
+
+    def needed(self, bits_per_unit=1):
+        """Number of units still to be read, unknown until the delimiter shows up."""
+        return None
+
+    def feed(self, bits):
+        if self.done:
+            return True
+        bits = np.concatenate((self._carry, bits))
+        n = len(bits) - len(bits) % 8
+        self._carry = bits[n:]
+        if n == 0:
+            return False
+        chunk = np.packbits(bits[:n])
+        window = np.concatenate((self._tail, chunk))
+        pos = find_sequence(window, self._delim)
+        if pos >= 0:
+            self._end = self._size - len(self._tail) + pos
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        self._tail = window[max(len(window) - len(self._delim) + 1, 0):]
+        return self.done
+
+    def message(self):
+        data = b''.join(chunk.tobytes() for chunk in self._chunks)
+        if self.done:
+            return data[:self._end]
+        if len(self._carry):
+            data += bytes([int(''.join(map(str, self._carry)), 2)])
+        return data
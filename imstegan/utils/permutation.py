@@ -0,0 +1,63 @@
+import numpy as np
+
+
+__all__ = ["KeyedPermutation"]
+
+
+_MUL1 = np.uint64(0x9E3779B97F4A7C15)
+_MUL2 = np.uint64(0xBF58476D1CE4E5B9)
+
+
+class KeyedPermutation():
+    """Keyed pseudo-random permutation of `[0, size)`.
+
+    A balanced Feistel network over the smallest even power of two covering
+    `size`, restricted to `[0, size)` by cycle walking. Any range of the
+    permuted sequence can be computed on demand, so the cost of walking a
+    path is proportional to the number of positions actually used rather
+    than to `size`.
+
+    Args:
+        key (int): Secret key the round keys are derived from.
+        size (int): Size of the permuted domain.
+        rounds (int): Number of Feistel rounds.
+    """
+    def __init__(self, key: int, size: int, rounds: int = 6) -> None:
+        if size < 1:
+            raise ValueError("Permutation size must be positive")
+        self.size = size
+        self._half = max((int(size - 1).bit_length() + 1) // 2, 1)
+        self._mask = np.uint64((1 << self._half) - 1)
+        self._keys = np.random.SeedSequence(key).generate_state(rounds, np.uint64)
+        self.dtype = np.uint32 if size <= 2**32 else np.uint64
+
+    def _round(self, x, k):
+        x = (x ^ k) * _MUL1
+        x ^= x >> np.uint64(29)
+        x *= _MUL2
+        x ^= x >> np.uint64(32)
+        return x & self._mask
+
+    def _encrypt(self, x):
+        half = np.uint64(self._half)
+        left, right = x >> half, x & self._mask
+        for k in self._keys:
+            left, right = right, left ^ self._round(right, k)
+        return (left << half) | right
+
+    def take(self, start: int, stop: int) -> np.ndarray:
+        """Returns the permuted indices at positions `[start, stop)`."""
+        stop = min(stop, self.size)
+        x = self._encrypt(np.arange(start, max(stop, start), dtype=np.uint64))
+        # Cycle walking: re-encrypt until every value falls inside the domain
+        outside = np.flatnonzero(x >= self.size)
+        while len(outside):
+            x[outside] = self._encrypt(x[outside])
+            outside = outside[x[outside] >= self.size]
+        return x.astype(self.dtype)
+
+    def blocks(self, count: int = None, block_size: int = 1 << 16):
+        """Yields the first `count` permuted indices as arrays of `block_size`."""
+        count = self.size if count is None else min(count, self.size)
+        for start in range(0, count, block_size):
+            yield self.take(start, min(start + block_size, count))
@@ -0,0 +1,129 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+__all__ = ["Profile", "profile", "stage"]
+
+
+# Profiles currently collecting, stages are only timed while this is not empty
+_profiles = []
+
+
+class Profile():
+    """Stage breakdown collected by `profile`.
+
+    `stages` maps every stage name, e.g. `'PVD.analyze'`, to its number of
+    calls, total seconds, pixels touched and bytes allocated, in the order
+    the stages were first seen. Bytes are only measured when the profile was
+    created with `memory=True`; they are the peak traced by `tracemalloc`
+    above the level at the start of the stage, the largest over its calls.
+
+    Args:
+        memory (bool): Measure allocations with `tracemalloc`.
+        callback (callable): Called with `(name, seconds, pixels, nbytes)`
+            at the end of every stage.
+    """
+    def __init__(self, memory=False, callback=None):
+        self.memory = memory
+        self.callback = callback
+        self.stages = {}
+
+    def _record(self, name, seconds, pixels, nbytes):
+        entry = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'pixels': 0, 'bytes': 0})
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        entry['pixels'] += pixels
+        entry['bytes'] = max(entry['bytes'], nbytes)
+        if self.callback is not None:
+            self.callback(name, seconds, pixels, nbytes)
+
+    @property
+    def total(self):
+        return sum(entry['seconds'] for entry in self.stages.values())
+
+    def as_dict(self):
+        return {name: dict(entry) for name, entry in self.stages.items()}
+
+    def report(self):
+        """The breakdown as a text table."""
+        total = self.total or 1
+        lines = [f"{'stage':24s} {'calls':>6s} {'ms':>10s} {'%':>6s} {'pixels':>12s} {'bytes':>12s}"]
+        for name, entry in self.stages.items():
+            lines.append(f"{name:24s} {entry['calls']:6d} {entry['seconds'] * 1e3:10.2f} "
+                         f"{100 * entry['seconds'] / total:6.1f} {entry['pixels']:12d} {entry['bytes']:12d}")
+        return '\n'.join(lines)
+
+
+class _Stage():
+    __slots__ = ('name', 'pixels', '_start', '_memory', '_base')
+
+    def __init__(self, name, pixels):
+        self.name = name
+        self.pixels = pixels
+        self._memory = any(p.memory for p in _profiles) and tracemalloc.is_tracing()
+
+    def touch(self, pixels):
+        """Adds to the number of pixels touched by the stage."""
+        self.pixels += int(pixels)
+
+    def __enter__(self):
+        if self._memory:
+            tracemalloc.reset_peak()
+            self._base = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        nbytes = tracemalloc.get_traced_memory()[1] - self._base if self._memory else 0
+        for p in _profiles:
+            p._record(self.name, seconds, self.pixels, nbytes if p.memory else 0)
+        return False
+
+
+class _NullStage():
+    """Stage used when nothing is profiled, it does nothing."""
+    __slots__ = ()
+
+    def touch(self, pixels):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name, pixels=0):
+    """
+    Context manager timing a named stage of an algorithm. Stages should not
+    be nested. Without an active `profile` it returns a shared no-op object,
+    so instrumented code costs a function call per stage.
+    """
+    if not _profiles:
+        return _NULL_STAGE
+    return _Stage(name, pixels)
+
+
+@contextmanager
+def profile(memory=False, callback=None):
+    """
+    Collects the stages run inside the `with` block, from every thread,
+    into the `Profile` it yields.
+    """
+    result = Profile(memory, callback)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _profiles.append(result)
+    try:
+        yield result
+    finally:
+        _profiles.remove(result)
+        if started:
+            tracemalloc.stop()
@@ -0,0 +1,47 @@
+"""A process that ran DCTScale off its main thread must still exit.
+
+numba's parallel kernels, launched from a worker thread, used to keep the
+interpreter from shutting down, see `imstegan.utils.dct8`. Every case runs
+in a fresh process, as the hang only shows at exit.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    'multichannel': """
+from imstegan import DCTScale
+from imstegan.bench import synthetic_carrier
+algorithm = DCTScale(multichannel=True)
+assert algorithm.extract(algorithm.embed(synthetic_carrier(64, 64, 3), 'hi')) == 'hi'
+""",
+    'aio': """
+import asyncio
+from imstegan import DCTScale
+from imstegan.aio import aembed, aextract
+from imstegan.bench import synthetic_carrier
+stego = asyncio.run(aembed(DCTScale(), synthetic_carrier(64, 64), 'hi'))
+assert asyncio.run(aextract(DCTScale(), stego)) == 'hi'
+""",
+    'thread': """
+import threading
+from imstegan import DCTScale
+from imstegan.bench import synthetic_carrier
+thread = threading.Thread(target=DCTScale().embed, args=(synthetic_carrier(64, 64), 'hi'))
+thread.start()
+thread.join()
+""",
+}
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_exits_after_threaded_dct(name):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    # Generous, the first run compiles the numba kernels
+    result = subprocess.run([sys.executable, '-c', CASES[name]], env=env, capture_output=True, timeout=120)
+    assert result.returncode == 0, result.stderr.decode()